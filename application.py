@@ -1,22 +1,28 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context
 from functools import wraps
 import os 
 import json
+import gzip
 from datetime import datetime
 import assistant
 import secval
 import uuid
-from data import db, Survey, ExperimentData, User, configure_database, is_development_mode, TaskCheck, CodeChange, SUS
+from data import db, Survey, ExperimentData, User, configure_database, is_development_mode, TaskCheck, CodeChange, CodeRevision, SUS, ConditionCount
 from dotenv import load_dotenv 
-import difflib
+import code_diff
 from dateutil.parser import isoparse
 import traceback
 from application_helper import is_development_mode, assign_balanced_condition, categorize_expertise_from_existing_survey
+from event_queue import create_event_writer
+from code_history import store_revision, code_hash
+from cpu_pool import create_cpu_pool_from_env, CPUPoolFullError, CPUTimeoutError
 import re
 
 load_dotenv()
 
-validator = secval.SimpleSecurityValidator()
+# Script parsing and diffing run in worker processes so large saves do not hold the GIL
+cpu_pool = create_cpu_pool_from_env(preload=("secval", "code_diff"))
+validator = secval.SimpleSecurityValidator(pool=cpu_pool)
 application = Flask(__name__)
 application.secret_key = os.environ.get("SECRET_KEY", "your_secret_key")
 
@@ -25,6 +31,9 @@ try:
 except Exception as e:
     print(f"Error configuring database: {e}")
 
+# Telemetry rows are written in batches by a background thread (see event_queue.py)
+event_writer = create_event_writer(application, db)
+
 @application.route("/gameAIassistant", methods=["GET", "POST"])
 def gameAIassistant():
     session_id = session.get('session_id')
@@ -77,6 +86,15 @@ def survey():
     
     return render_template('survey.html', session_id=session_id)
 
+# Per-session game code (cached, written atomically); the assistant reads the same store
+code_store = assistant.code_store
+
+# Answered assistant turns are appended to ConversationTurn by the background writer
+if not is_development_mode():
+    assistant.turn_hooks.append(
+        lambda session_id, user_id, messages: event_writer.enqueue_call(
+            assistant.save_conversation_to_db, session_id, messages, user_id))
+
 @application.route("/save-code", methods=["POST"])
 def save_code():
     try:
@@ -87,7 +105,7 @@ def save_code():
         user_id = session['user_id']
         print(f"Session ID: {session_id}, User ID: {user_id}")
         
-        validation_result = validator.validate(code)
+        validation_result = validator.validate_incremental(session_id, code)
         is_safe = validation_result['is_safe']
         violations = validation_result['violations']
         
@@ -104,18 +122,9 @@ def save_code():
             return jsonify({"success": False, "error": "Invalid file name"})
 
         print(f"Saving code for session {session_id} with user ID {user_id} and file name {file_name}")
-        user_file_path = os.path.join(application.static_folder, "js", "users", f"game_{session_id}.js")
-        os.makedirs(os.path.dirname(user_file_path), exist_ok=True)
-        
-        print(f"User file path: {user_file_path}")
-        
-        prev_code = ""
-        if os.path.exists(user_file_path):
-            print(f"Loading previous code from {user_file_path}")
-            with open(user_file_path, "r", encoding="utf-8") as f:
-                prev_code = f.read()
-        prev_lines = prev_code.split('\n') if prev_code else []
-        diff = list(difflib.unified_diff(prev_lines, code_lines, lineterm=''))        
+        # Before the first save the session's code is the template, so the first diff is against it
+        prev_code, prev_lines = code_store.load_or_template(session_id)
+        diff, lines_added, lines_removed = cpu_pool.run(code_diff.unified_diff, prev_lines, code_lines)
 
         last_ai_usage = session.get('last_ai_usage')
         last_code_save = session.get('last_code_save')
@@ -132,31 +141,25 @@ def save_code():
                 used_ai = False
                 
         if user_id and diff:
-            prev_code_str = '\n'.join(prev_lines)
-            new_code_str = code
-            lines_changed = len(diff)
-            lines_added = sum(1 for d in diff if d.startswith('+') and not d.startswith('+++'))
-            lines_removed = sum(1 for d in diff if d.startswith('-') and not d.startswith('---'))
-            code_change = CodeChange(
-                user_id=user_id,
-                participant_code=session.get('participant_code', 'unknown'),
-                code_before=prev_code_str,
-                code_after=new_code_str,
-                lines_changed=lines_changed,
-                lines_added=lines_added,
-                lines_removed=lines_removed,
-                timestamp=datetime.now()
-            )
             if not is_development_mode():
-                db.session.add(code_change)
-                db.session.commit()
+                # The revision is numbered and written by the background writer, in the order of
+                # this process's saves; the code itself is stored as keyframes + diffs
+                change = CodeChange(
+                    user_id=user_id,
+                    participant_code=session.get('participant_code', 'unknown'),
+                    session_id=session_id,
+                    lines_changed=len(diff),
+                    lines_added=lines_added,
+                    lines_removed=lines_removed,
+                    timestamp=datetime.now()
+                )
+                event_writer.enqueue_call(write_code_revision, session_id, prev_code, code, diff, change)
             else:
                 print("[DEV] Skipping DB commit for code_change (development mode)")
                 
         
-        # Save new code to file
-        with open(user_file_path, "w", encoding="utf-8", newline='') as f:
-            f.write(code)
+        # Save new code for the session
+        code_store.save(session_id, code, code_lines)
 
         # Log code save action to experiment data
         if user_id:
@@ -175,8 +178,7 @@ def save_code():
             )
             # Only commit to DB if not in development mode
             if not is_development_mode():
-                db.session.add(experiment_data)
-                db.session.commit()
+                event_writer.enqueue(experiment_data)
             else:
                 print("[DEV] Skipping DB commit for experiment_data (development mode)")
         else:
@@ -185,9 +187,29 @@ def save_code():
         session['last_code_save'] = datetime.now().isoformat()
         
         return jsonify({"success": True})
+    except CPUPoolFullError as e:
+        return jsonify({"success": False, "error": str(e)}), 503
+    except CPUTimeoutError as e:
+        print(f"Checking code for session {session_id} timed out: {e}")
+        return jsonify({"success": False, "error": "Saving took too long; please try again"}), 503
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+def write_code_revision(session_id, prev_code, code, diff, change):
+    """Store the next CodeRevision of a session and its CodeChange; runs on the event writer"""
+    try:
+        change.revision = store_revision(
+            db, CodeRevision, session_id, prev_code, code, diff,
+            user_id=change.user_id,
+            participant_code=change.participant_code
+        )
+    except Exception as e:
+        # The CodeChange is still logged; the next revision will be a keyframe
+        db.session.rollback()
+        print(f"Error storing code revision for session {session_id}: {e}")
+    db.session.add(change)
+    db.session.commit()
+
 @application.route("/log-error", methods=["POST"])
 def log_error():
     try:
@@ -218,8 +240,7 @@ def log_error():
             )
             # Only commit to DB if not in development mode
             if not is_development_mode():
-                db.session.add(experiment_data)
-                db.session.commit()
+                event_writer.enqueue(experiment_data)
             else:
                 print("[DEV] Skipping DB commit for experiment_data (development mode)")
         
@@ -229,6 +250,82 @@ def log_error():
         return jsonify({"success": False, "error": str(e)})
 
 
+# Pattern matches ```lang\ncode``` or ```\ncode```
+CODE_BLOCK_PATTERN = re.compile(r"```(\w+)?\n(.*?)```", re.DOTALL)
+
+def split_segments(response):
+    """Split an LLM response into ["text", ...] and ["code", ...] segments"""
+    segments = []
+    last_end = 0
+    for match in CODE_BLOCK_PATTERN.finditer(response):
+        # Add preceding text, if any
+        if match.start() > last_end:
+            text = response[last_end:match.start()].strip()
+            if text:
+                segments.append(["text", text])
+        code = match.group(2).strip()
+        #lang = match.group(1) or ""
+        segments.append(["code", code])
+        last_end = match.end()
+    # Add any trailing text
+    if last_end < len(response):
+        text = response[last_end:].strip()
+        if text:
+            segments.append(["text", text])
+    return segments
+
+def log_llm_message(session_id, user_id, participant_code, user_message, response, extended_thinking):
+    """Save user message and LLM response to ExperimentData"""
+    event_writer.enqueue(ExperimentData(
+        session_id=session_id,
+        user_id=user_id,
+        participant_code=participant_code,
+        user_action="llm_message",
+        timestamp=datetime.now(),
+        data=json.dumps({
+            "user_message": user_message,
+            "llm_response": response,
+            "extended_thinking": extended_thinking
+        })
+    ))
+
+def stream_llm_segments(user_message, session_id, user_id, participant_code, condition=None):
+    """Yield newline-delimited JSON events: tokens as they arrive, segments once complete"""
+    buffer = ""
+    chunks = []
+    emitted = False
+    degraded = False
+    try:
+        for delta in assistant.stream_llm_response([], user_message, session_id, user_id, condition):
+            degraded = degraded or assistant.is_degraded(delta)
+            chunks.append(delta)
+            buffer += delta
+            yield json.dumps({"type": "token", "text": delta}) + "\n"
+
+            # Emit every code block that has been closed, with the text before it
+            last_end = 0
+            for match in CODE_BLOCK_PATTERN.finditer(buffer):
+                for segment in split_segments(buffer[last_end:match.end()]):
+                    emitted = True
+                    yield json.dumps({"type": "segment", "segment": segment, "pending": buffer[match.end():]}) + "\n"
+                last_end = match.end()
+            buffer = buffer[last_end:]
+
+        response = "".join(chunks)
+        segments = split_segments(buffer)
+        if not segments and not emitted:
+            segments.append(["text", response])
+        for segment in segments:
+            yield json.dumps({"type": "segment", "segment": segment, "pending": ""}) + "\n"
+
+        # A degraded reply is not an AI answer, so it is left out of the study data
+        if user_id and not degraded:
+            log_llm_message(session_id, user_id, participant_code, user_message, response, False)
+        yield json.dumps({"type": "done", "degraded": degraded}) + "\n"
+    except Exception as e:
+        print(f"Error streaming LLM response: {e}")
+        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+
 @application.route("/LLMrequest", methods=["POST"])
 def LLMrequest():
     try:
@@ -236,60 +333,52 @@ def LLMrequest():
         context = data.get("context", [])
         user_message = data.get("input", "")
         extended_thinking = data.get("extended_thinking", False)
+        stream = data.get("stream", False)
         session_id = session.get('session_id', f"session_{uuid.uuid4().hex[:12]}")
         if 'session_id' not in session:
             session['session_id'] = session_id
         user_id = session.get('user_id')
         print(f"[DEBUG] Accessed user_id from session: {user_id}")
+
+        if stream and not extended_thinking:
+            # Session cookie is sent with the headers, so update it before streaming starts
+            if not assistant.llm_breaker.is_open():
+                session['last_ai_usage'] = datetime.now().isoformat()
+            return Response(
+                stream_with_context(stream_llm_segments(
+                    user_message, session_id, user_id, session.get('participant_code', 'unknown'),
+                    session.get('assigned_condition')
+                )),
+                mimetype="application/x-ndjson",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
         response = ""
         if extended_thinking:
             response = assistant.get_react_response(context, user_message, session_id, user_id)
+            if isinstance(response, dict) and "error" in response:
+                return jsonify(response)
         else:
-            response = assistant.get_llm_response(context, user_message, session_id, user_id)
+            response = assistant.get_llm_response(context, user_message, session_id, user_id,
+                                                  session.get('assigned_condition'))
 
-        # Save user message and LLM response to ExperimentData
-        if user_id:
-            db.session.add(ExperimentData(
-                session_id=session_id,
-                user_id=user_id,
-                participant_code=session.get('participant_code', 'unknown'),
-                user_action="llm_message",
-                timestamp=datetime.now(),
-                data=json.dumps({
-                    "user_message": user_message,
-                    "llm_response": response,
-                    "extended_thinking": extended_thinking
-                })
-            ))
-            db.session.commit()
-        session['last_ai_usage'] = datetime.now().isoformat()
-
-        segments = []
-        # Pattern matches ```lang\ncode``` or ```\ncode```
-        pattern = re.compile(r"```(\w+)?\n(.*?)```", re.DOTALL)
-        last_end = 0
-        for match in pattern.finditer(response):
-            # Add preceding text, if any
-            if match.start() > last_end:
-                text = response[last_end:match.start()].strip()
-                if text:
-                    segments.append(["text", text])
-            code = match.group(2).strip()
-            #lang = match.group(1) or ""
-            segments.append(["code", code])
-            last_end = match.end()
-        # Add any trailing text
-        if last_end < len(response):
-            text = response[last_end:].strip()
-            if text:
-                segments.append(["text", text])
+        degraded = assistant.is_degraded(response)
+        if user_id and not degraded:
+            log_llm_message(session_id, user_id, session.get('participant_code', 'unknown'),
+                            user_message, response, extended_thinking)
+        if not degraded:
+            session['last_ai_usage'] = datetime.now().isoformat()
+
+        segments = split_segments(response)
         if not segments:
             segments.append(["text", response])
 
-
-        return jsonify(segments)
+        result = jsonify(segments)
+        if degraded:
+            result.headers['X-AI-Degraded'] = '1'
+        return result
     except Exception as e:
-        return jsonify(["text", text])
+        return jsonify({"error": str(e)})
     
 @application.route("/sus", methods=["GET", "POST"])
 def sus():
@@ -354,11 +443,9 @@ def debrief():
         if user:
             participant_code = user.participant_code
             
-    user_file_path = os.path.join(application.static_folder, "js", "users", f"game_{session_id}.js")
     try:
-        if os.path.exists(user_file_path):
-            os.remove(user_file_path)
-            print(f"Deleted user game.js file: {user_file_path}")
+        code_store.delete(session_id)
+        print(f"Deleted game code for session {session_id}")
     except Exception as e:
         print(f"Error deleting user game.js file: {e}")
 
@@ -382,22 +469,14 @@ def save_final_game_code():
         print(f"[DEBUG] Accessed user_id from session: {user_id}")
         if not user_id:
             return jsonify({"success": False, "error": "No user_id in session"}), 400
-        user_file_path = os.path.join(application.static_folder, "js", "users", f"game_{session_id}.js")
-        if not os.path.exists(user_file_path):
-            return jsonify({"success": False, "error": "User game.js file not found"}), 404
-        with open(user_file_path, "r", encoding="utf-8") as f:
-            code = f.read()
+        # Sessions that never saved finished with the template
+        code, _ = code_store.get_or_template(session_id)
         experiment_data = ExperimentData(
             session_id=session_id,
             user_id=user_id,
             user_action="final_code_save",
             timestamp=datetime.now(),
-            data=json.dumps({
-                "file_name": f"game_{session_id}.js",
-                "final_code": code,
-                "code_length": len(code),
-                "lines_count": len(code.split('\n'))
-            })
+            data=json.dumps(final_code_data(session_id, code))
         )
         if not is_development_mode():
             db.session.add(experiment_data)
@@ -408,28 +487,66 @@ def save_final_game_code():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+# How long the final save waits for queued revisions before storing the code in full
+FINAL_CODE_FLUSH_TIMEOUT = float(os.environ.get("FINAL_CODE_FLUSH_TIMEOUT", "2"))
+
+def final_code_data(session_id, code):
+    """ExperimentData payload for the final code.
+
+    When the code is the session's latest stored CodeRevision the payload refers to that
+    revision; otherwise the code itself is included.
+    """
+    final_data = {
+        "file_name": f"game_{session_id}.js",
+        "code_length": len(code),
+        "lines_count": len(code.split('\n')),
+    }
+    final_hash = code_hash(code)
+    latest = None
+    if not is_development_mode():
+        event_writer.flush(FINAL_CODE_FLUSH_TIMEOUT)
+        latest = (CodeRevision.query.with_entities(CodeRevision.id, CodeRevision.revision, CodeRevision.code_hash)
+                  .filter(CodeRevision.session_id == session_id)
+                  .order_by(CodeRevision.revision.desc())
+                  .first())
+    if latest is not None and latest.code_hash == final_hash:
+        final_data["revision"] = latest.revision
+        final_data["revision_id"] = latest.id
+        final_data["code_hash"] = final_hash
+    else:
+        final_data["final_code"] = code
+    return final_data
+
+# Game code responses larger than this are gzipped for clients that accept it
+CODE_GZIP_MIN_BYTES = int(os.environ.get("CODE_GZIP_MIN_BYTES", "1024"))
+
 @application.route("/get-user-game-code", methods=["GET"])
 def get_user_game_code():
     """Get user-specific game code"""
     try:
         session_id = session.get('session_id', 'unknown')
-        user_file_path = os.path.join(application.static_folder, "js", "users", f"game_{session_id}.js")
-        
-        # If user file doesn't exist, copy from template
-        if not os.path.exists(user_file_path):
-            template_path = os.path.join(application.static_folder, "js", "game.js")
-            os.makedirs(os.path.dirname(user_file_path), exist_ok=True)
-            
-            with open(template_path, "r", encoding="utf-8") as template_file:
-                template_content = template_file.read()
-            
-            with open(user_file_path, "w", encoding="utf-8") as user_file:
-                user_file.write(template_content)
-        
-        with open(user_file_path, "r", encoding="utf-8") as f:
-            code = f.read()
-        
-        return jsonify({"success": True, "code": code})
+        # Sessions that have not saved yet are served the template from memory
+        code, etag = code_store.get_with_etag(session_id)
+        gzipped = (CODE_GZIP_MIN_BYTES > 0 and len(code) >= CODE_GZIP_MIN_BYTES and
+                   request.accept_encodings['gzip'] > 0)
+        if gzipped:
+            # Strong ETags are per representation, so the gzip body gets its own
+            etag = f"{etag}-gzip"
+
+        # If-None-Match uses weak comparison; proxies that re-encode the body send W/ back
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify({"success": True, "code": code})
+            if gzipped:
+                response.set_data(gzip.compress(response.get_data()))
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        # The browser keeps the script but revalidates it on every load
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+        response.vary.add('Cookie')
+        return response
     
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -494,7 +611,10 @@ def submit_survey():
         )
         
         expertise = categorize_expertise_from_existing_survey(survey_data)
-        assigned_condition = assign_balanced_condition(User, expertise)
+        # Reserves a slot in the ConditionCount row, committed below with the user
+        assigned_condition = assign_balanced_condition(
+            db, User, ConditionCount, expertise, reserve=not is_development_mode()
+        )
         
         session["assigned_condition"] = assigned_condition
 
@@ -569,6 +689,27 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
+@application.route("/llm-metrics")
+@requires_auth
+def llm_metrics():
+    """Queueing, latency and cache counters for the assistant and background work"""
+    return jsonify({
+        "pool": assistant.llm_pool.metrics(),
+        "analysis_cache": assistant.analysis_cache.stats(),
+        "response_cache": assistant.response_cache.stats(),
+        "react": dict(assistant.react_stats),
+        "usage": assistant.usage_metrics(),
+        "rate_limit": assistant.rate_limiter.metrics(),
+        "breakers": {
+            "llm": assistant.llm_breaker.metrics(),
+            "docs_web": assistant.docs_web_breaker.metrics()
+        },
+        "conversations": assistant.conversations.stats(),
+        "events": event_writer.stats(),
+        "cpu": cpu_pool.metrics(),
+        "code_store": code_store.stats()
+    })
+
 @application.route("/init-db")
 #@requires_auth
 def init_database():
@@ -625,8 +766,7 @@ def log_task_check():
             participant_code=session.get('participant_code', 'unknown'),
             task_id=task_id,
         )
-        db.session.add(task_check)
-        db.session.commit()
+        event_writer.enqueue(task_check)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -651,8 +791,7 @@ def log_game_reload():
             })
         )
         if not is_development_mode():
-            db.session.add(db_entry)
-            db.session.commit()
+            event_writer.enqueue(db_entry)
         else:
             print("[DEV] Skipping DB commit for game_reload (development mode)")
         return jsonify({"success": True})
@@ -671,25 +810,15 @@ def log_experiment_leave():
         print(f"[DEBUG] Accessed user_id from session: {user_id}")
         if not user_id:
             return jsonify({"success": False, "error": "No user_id in session"}), 400
-        user_file_path = os.path.join(application.static_folder, "js", "users", f"game_{session_id}.js")
-        if not os.path.exists(user_file_path):
-            print(f"[DEBUG] User game.js file not found at {user_file_path}")
-            return jsonify({"success": False, "error": "User game.js file not found"}), 404
-        with open(user_file_path, "r", encoding="utf-8") as f:
-            print(f"[DEBUG] Reading user game.js file at {user_file_path}")
-            code = f.read()
+        # Sessions that never saved finished with the template
+        code, _ = code_store.get_or_template(session_id)
         experiment_data = ExperimentData(
             session_id=session_id,
             user_id=user_id,
             user_action="final_code_save",
             participant_code=participant_code,
             timestamp=datetime.now(),
-            data=json.dumps({
-                "file_name": f"game_{session_id}.js",
-                "final_code": code,
-                "code_length": len(code),
-                "lines_count": len(code.split('\n'))
-            })
+            data=json.dumps(final_code_data(session_id, code))
         )
         if not is_development_mode():
             db.session.add(experiment_data)
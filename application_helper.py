@@ -1,39 +1,66 @@
 import os
 import random
 import json
+from sqlalchemy.exc import IntegrityError
 
 def is_development_mode():
     return os.environ.get('FLASK_ENV', '').lower() == 'development'
 
-def assign_balanced_condition(User, expertise_level=None):
+CONDITIONS = ('ai', 'control')
+
+def assign_balanced_condition(db, User, ConditionCount, expertise_level=None, reserve=True):
+    """Pick the condition with fewer participants at this expertise level (ties go to 'ai').
+
+    Counts come from the level's ConditionCount rows, which are locked until the caller
+    commits or rolls back; with reserve the chosen condition's count is incremented in
+    the same transaction, so the caller should commit it together with the new User.
+    Concurrent sign-ups at a level therefore queue instead of reading the same counts.
+    """
+    level = expertise_level or 'unknown'
     try:
-        ai_count = 0
-        control_count = 0
-        if expertise_level == 'low':
-            ai_count = User.query.filter_by(assigned_condition='ai', expertise_level='low').count() or 0
-            control_count = User.query.filter_by(assigned_condition='control', expertise_level='low').count() or 0
-        elif expertise_level == 'medium':
-            ai_count = User.query.filter_by(assigned_condition='ai', expertise_level='medium').count() or 0
-            control_count = User.query.filter_by(assigned_condition='control', expertise_level='medium').count() or 0
-        elif expertise_level == 'high':
-            ai_count = User.query.filter_by(assigned_condition='ai', expertise_level='high').count() or 0
-            control_count = User.query.filter_by(assigned_condition='control', expertise_level='high').count() or 0
-        total_count = ai_count + control_count
+        rows = _locked_condition_counts(db, User, ConditionCount, level)
+        counts = {row.assigned_condition: row.count for row in rows}
+        ai_count = counts.get('ai', 0)
+        control_count = counts.get('control', 0)
         print(f"Current balance - AI: {ai_count}, Control: {control_count}")
-        if total_count == 0:
-            assigned_condition = 'ai'
-        elif ai_count < control_count:
-            assigned_condition = 'ai'
-        elif control_count < ai_count:
-            assigned_condition = 'control'
-        else:
-            assigned_condition = 'ai'
+        assigned_condition = 'control' if control_count < ai_count else 'ai'
+        if reserve:
+            for row in rows:
+                if row.assigned_condition == assigned_condition:
+                    row.count = ConditionCount.count + 1  # Incremented in SQL
         print(f"Assigned condition: {assigned_condition}")
         
         return assigned_condition
     except Exception as e:
+        db.session.rollback()
         print(f"Error in condition assignment: {e}")
-        return random.choice(['ai', 'control'])
+        return random.choice(list(CONDITIONS))
+
+def _locked_condition_counts(db, User, ConditionCount, level):
+    query = ConditionCount.query.filter_by(expertise_level=level).with_for_update()
+    rows = query.all()
+    if len(rows) < len(CONDITIONS):
+        # First sign-up at this level since the counters were added: seed them from User
+        existing = {row.assigned_condition for row in rows}
+        totals = dict(
+            db.session.query(User.assigned_condition, db.func.count(User.id))
+            .filter(User.expertise_level == level)
+            .group_by(User.assigned_condition)
+            .all()
+        )
+        try:
+            with db.session.begin_nested():
+                for condition in CONDITIONS:
+                    if condition not in existing:
+                        db.session.add(ConditionCount(
+                            expertise_level=level,
+                            assigned_condition=condition,
+                            count=totals.get(condition, 0)
+                        ))
+        except IntegrityError:
+            pass  # Seeded by a concurrent sign-up
+        rows = query.all()
+    return rows
 
 def get_int_user_id(session):
     user_id = session.get('user_id')
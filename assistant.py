@@ -1,10 +1,25 @@
-from openai import OpenAI
+from openai import OpenAI, RateLimitError, APIConnectionError, InternalServerError
 from dotenv import load_dotenv
 from datetime import datetime
 import os
+import time
+import threading
+import contextvars
 import boto3
 import tiktoken
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from llm_pool import create_pool_from_env, LLMTimeoutError
+from rate_limiter import create_rate_limiter_from_env
+from circuit_breaker import create_breaker_from_env, CircuitOpenError
+from cache import TTLCache, content_hash
+from docs_index import DocsIndex, format_entry
+from context_window import ContextWindow, message_text
+from conversation_store import create_store_from_env
+from code_store import create_code_store_from_env
+from response_cache import create_response_cache_from_env
 
 #print("Loading OpenAI API key from AWS Secrets Manager...")
 
@@ -35,170 +50,551 @@ except Exception as e:
     print("Could not load OpenAI API key from AWS Secrets Manager:", e)
 
 load_dotenv()
-client = OpenAI(api_key=openai_api_key)
 
-# Dictionary to store conversations by session_id
-conversations = {}
+# All model calls go through a shared bounded pool (see llm_pool.py). It caps how many run at
+# once and gives each a deadline; the request thread still waits for its reply.
+llm_pool = create_pool_from_env()
+
+# Retries are left to create_response so they are paced by rate_limiter. The client gives up at
+# the pool's deadline too, so calls to a hung API do not keep holding the pool's threads.
+client = OpenAI(api_key=openai_api_key, max_retries=0, timeout=llm_pool.timeout)
+
+# Model calls fail fast while the API keeps failing or answering slowly (see circuit_breaker.py).
+# A full code example can take half a minute, so only calls slower than that count against it.
+llm_breaker = create_breaker_from_env("AI", "LLM", slow_call=45.0)
+# Errors that mean the API is unhealthy, as opposed to a bad request or our own rate limit
+BACKEND_ERRORS = (LLMTimeoutError, APIConnectionError, InternalServerError)
+
+class DegradedReply(str):
+    """Text sent in place of a model reply while llm_breaker is open"""
+
+DEGRADED_REPLY = DegradedReply("The AI assistant is not responding right now, so it could not answer. Please try again in a minute. Your code and progress are saved.")
+
+def is_degraded(reply):
+    """True for DEGRADED_REPLY, which is not an answer and should not be logged as one"""
+    return isinstance(reply, DegradedReply)
+
+# Paces calls on the shared API key from its rate-limit headers (see rate_limiter.py).
+# Calls made while answering a participant go before background work; that includes the
+# summaries and tool calls of the request, so it follows the request rather than the purpose.
+rate_limiter = create_rate_limiter_from_env()
+interactive_request = contextvars.ContextVar("interactive_request", default=False)
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+# Output tokens assumed for a call that sets no max_output_tokens, when pacing it
+EXPECTED_OUTPUT_TOKENS = int(os.environ.get("RATE_LIMIT_EXPECTED_OUTPUT_TOKENS", "1024"))
+
+# Token usage per kind of call. cached_tokens counts prompt tokens the provider served from
+# its prefix cache, so prompts keep their static instructions first and variable content last.
+usage_stats = {}
+usage_lock = threading.Lock()
+# Callables taking (purpose, usage dict) that are called after every model response
+usage_hooks = []
+# Callables taking (session_id, user_id, messages) that are called with every answered turn,
+# e.g. to queue save_conversation_to_db
+turn_hooks = []
+
+def record_usage(purpose, usage):
+    """Add a response's token usage to usage_stats and pass it to the usage hooks"""
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    counts = {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0
+    }
+    with usage_lock:
+        totals = usage_stats.setdefault(purpose, {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0})
+        totals["calls"] += 1
+        for key, value in counts.items():
+            totals[key] += value
+    for hook in usage_hooks:
+        try:
+            hook(purpose, counts)
+        except Exception as e:
+            print(f"Usage hook failed: {e}")
+
+def usage_metrics():
+    """Snapshot of usage_stats with the share of input tokens served from the prompt cache"""
+    with usage_lock:
+        stats = {purpose: dict(totals) for purpose, totals in usage_stats.items()}
+    for totals in stats.values():
+        totals["cached_ratio"] = round(totals["cached_tokens"] / totals["input_tokens"], 3) if totals["input_tokens"] else 0.0
+    return stats
+
+def estimate_tokens(kwargs):
+    """Rough token cost of a call for pacing, at about four characters per token"""
+    prompt_chars = len(str(kwargs.get("instructions") or "")) + len(str(kwargs.get("input") or ""))
+    return prompt_chars // 4 + (kwargs.get("max_output_tokens") or EXPECTED_OUTPUT_TOKENS)
+
+def call_responses_api(**kwargs):
+    """client.responses.create, passing the rate-limit headers of the reply to rate_limiter.
+
+    Returns (response, seconds until the API answered). The call is timed here, in the
+    pool's thread, so time spent queued for the pool is not taken for API latency.
+    """
+    started_at = time.monotonic()
+    raw = client.responses.with_raw_response.create(**kwargs)
+    elapsed = time.monotonic() - started_at
+    rate_limiter.update(raw.headers)
+    return raw.parse(), elapsed
+
+def stream_responses_api(**kwargs):
+    """Yield the seconds until the API answered a streaming call, then the call's events"""
+    stream, elapsed = call_responses_api(stream=True, **kwargs)
+    yield elapsed
+    yield from stream
+
+def backoff_or_raise(purpose, attempt, error):
+    """Sleep before retrying a failed call, or re-raise the error once retries are used up"""
+    if attempt >= rate_limiter.max_retries or getattr(error, "code", None) == "insufficient_quota":
+        raise error
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    delay = rate_limiter.retry_delay(attempt, headers, rate_limited=isinstance(error, RateLimitError))
+    print(f"{purpose} call failed ({type(error).__name__}), retry {attempt + 1} in {delay:.2f}s")
+    time.sleep(delay)
+
+def record_llm_error(error, deadline=None):
+    """Count error against llm_breaker if it means the API is unhealthy, otherwise release its slot.
+
+    A timeout only counts when the call had the pool's full deadline; one the caller cut
+    short, e.g. to fit the ReAct time budget, says nothing about the API.
+    """
+    shortened = isinstance(error, LLMTimeoutError) and deadline is not None and deadline < llm_pool.timeout
+    if isinstance(error, BACKEND_ERRORS) and not shortened:
+        llm_breaker.record_failure()
+    else:
+        llm_breaker.release()
+
+@contextmanager
+def interactive_calls():
+    """Pace the model calls made inside the block (or decorated function) as interactive"""
+    token = interactive_request.set(True)
+    try:
+        yield
+    finally:
+        interactive_request.reset(token)
+
+def create_response(purpose="other", interactive=None, **kwargs):
+    """Run client.responses.create in the LLM pool with the pool's deadline and record its usage.
+
+    Calls are paced by rate_limiter and retried on rate limits and transient API errors;
+    interactive defaults to whether the call is made inside interactive_calls().
+    Raises CircuitOpenError without calling the API while llm_breaker is open.
+    """
+    kwargs.setdefault("timeout", llm_pool.timeout)
+    if interactive is None:
+        interactive = interactive_request.get()
+    attempt = 0
+    while True:
+        llm_breaker.allow()
+        try:
+            rate_limiter.acquire(estimate_tokens(kwargs), interactive)
+            response, elapsed = llm_pool.call(call_responses_api, **kwargs)
+        except Exception as e:
+            record_llm_error(e, kwargs["timeout"])
+            if not isinstance(e, RETRYABLE_ERRORS):
+                raise
+            backoff_or_raise(purpose, attempt, e)
+            attempt += 1
+            continue
+        llm_breaker.record_success(elapsed)
+        break
+    record_usage(purpose, getattr(response, "usage", None))
+    return response
+
+def stream_response(purpose="chat", interactive=None, **kwargs):
+    """Stream client.responses.create events through the LLM pool, paced and retried like create_response.
+
+    A call is only retried if it fails before its first event.
+    """
+    if interactive is None:
+        interactive = interactive_request.get()
+    attempt = 0
+    while True:
+        llm_breaker.allow()
+        # The breaker's slot is settled once: by the first event, by the error, or in finally
+        settled = False
+        started = False
+        elapsed = None
+        try:
+            rate_limiter.acquire(estimate_tokens(kwargs), interactive)
+            for event in llm_pool.stream(stream_responses_api, **kwargs):
+                if elapsed is None:
+                    elapsed = event
+                    continue
+                if not started:
+                    started = settled = True
+                    # The wait for the reply to start is the API's latency; the rest depends on its length
+                    llm_breaker.record_success(elapsed)
+                yield event
+            return
+        except Exception as e:
+            if started:
+                if isinstance(e, BACKEND_ERRORS):
+                    llm_breaker.record_failure()
+                raise
+            settled = True
+            record_llm_error(e, kwargs.get("timeout"))
+            if not isinstance(e, RETRYABLE_ERRORS):
+                raise
+            backoff_or_raise(purpose, attempt, e)
+            attempt += 1
+        finally:
+            if not settled:
+                # Abandoned before the first event, e.g. the client went away
+                llm_breaker.release()
+
+# Runs the tools of a ReAct step concurrently; model calls inside them still go through llm_pool.
+# Tools are submitted with a copy of the request's context so their calls keep its pacing.
+tool_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("TOOL_MAX_WORKERS", "4")), thread_name_prefix="tool")
+
+# Bump ANALYZE_PROMPT_VERSION whenever the analyze_code prompt changes so stale analyses are not reused
+ANALYZE_PROMPT_VERSION = "2"
+analysis_cache = TTLCache(
+    max_size=int(os.environ.get("ANALYSIS_CACHE_SIZE", "256")),
+    ttl=float(os.environ.get("ANALYSIS_CACHE_TTL", "3600"))
+)
+
+# Phaser API docs are searched locally; the DuckDuckGo lookup is only used when enabled
+try:
+    phaser_docs = DocsIndex.load(os.environ.get("PHASER_DOCS_PATH", "docs/phaser3_api.json"))
+except Exception as e:
+    print(f"Could not load Phaser docs index: {e}")
+    phaser_docs = DocsIndex([])
+DOCS_WEB_FALLBACK = os.environ.get("PHASER_DOCS_WEB_FALLBACK", "").lower() in ("1", "true", "yes")
+DOCS_WEB_TIMEOUT = float(os.environ.get("PHASER_DOCS_WEB_TIMEOUT", "10"))
+# While the web search keeps failing or answering slowly, searches skip it
+docs_web_breaker = create_breaker_from_env("docs search", "DOCS_WEB", slow_call=3.0)
+
+# Conversations by session_id; see conversation_store.py for the backends
+conversations = create_store_from_env()
+
+# Per-session game code, shared with application.py; see code_store.py for the backends
+code_store = create_code_store_from_env()
+
+# Opt-in cache of replies to repeated questions. RESPONSE_CACHE=first only caches a session's
+# opening question, since later replies depend on the conversation; "any" caches every turn.
+RESPONSE_CACHE_MODE = os.environ.get("RESPONSE_CACHE", "off").lower()
+# Conditions get separate cache namespaces unless this is set
+RESPONSE_CACHE_SHARE_CONDITIONS = os.environ.get("RESPONSE_CACHE_SHARE_CONDITIONS", "").lower() in ("1", "true", "yes")
+response_cache = create_response_cache_from_env()
 
 def get_response(prompt="", content="", model="gpt-4.1-mini"):
     # Initialize conversation for new sessions
-    response = client.responses.create(
+    response = create_response(
+        purpose="prompt",
         model=model,
         instructions=prompt,
         input=content
     )
     
-    headers = getattr(response, 'headers', {})
-    requests_left = headers.get('x-ratelimit-remaining-requests', 'Unknown')
-    tokens_left = headers.get('x-ratelimit-remaining-tokens', 'Unknown')    
-    
     print(f"Response: {response}")
-    # WARN IF LOW
-    if requests_left != 'Unknown' and int(requests_left) < 10:
-        print(" WARNING: Less than 10 requests remaining!")
-    
-    if tokens_left != 'Unknown' and int(tokens_left) < 1000:
-        print("WARNING: Less than 1000 tokens remaining!")
 
     return response.output_text
 
 def get_conversation(session_id):
     """Get conversation history for a specific session"""
-    return conversations.get(session_id, [])
+    return conversations.get(session_id)
+
+def add_message(session_id, message):
+    """Append a message to the session and add its content tokens to the running total"""
+    conversations.append(session_id, message)
+    if "content" in message:
+        conversations.set_meta(session_id, "tokens", get_conversation_tokens(session_id) + count_tokens(message["content"]))
+
+def get_conversation_tokens(session_id):
+    """Token count of all message content in the session, without re-tokenizing the history"""
+    return conversations.get_meta(session_id, "tokens", 0)
 
 def clear_conversation(session_id):
-    if session_id in conversations:
-        del conversations[session_id]
+    conversations.clear(session_id)
 
 def get_gamescript(session_id="default"):
     try:
-        # Each user gets their own game file
-        user_game_file = f"static/js/users/game_{session_id}.js"
-        
-        # If user file doesn't exist, copy from template
-        if not os.path.exists(user_game_file):
-            import shutil
-            os.makedirs("static/js/users", exist_ok=True)
-            shutil.copy("static/js/game.js", user_game_file)
-        
-        with open(user_game_file, "r") as file:
-            return file.read()
+        # Sessions that have not saved yet are working on the template
+        return code_store.get_or_template(session_id)[0]
     except FileNotFoundError:
         return "Error: game.js template file not found"
     except Exception as e:
         return f"Error reading game file: {e}"
 
-def save_conversation_to_db(session_id, user_id=None):
-    """Save conversation to database with user tracking"""
+def save_conversation_to_db(session_id, messages, user_id=None):
+    """Append messages to the session's ConversationTurn rows.
+
+    Their turn indexes are allocated inside the database by one upsert on the session's
+    ConversationTurnCount row, seeded from MAX(turn_index) for sessions saved before the
+    counter existed. The counter row stays locked until the turns are committed, so
+    concurrent saves for a session queue there while other sessions are not held up,
+    and numbering carries on across clears, evictions and restarts.
+    """
+    from data import ConversationTurn, ConversationTurnCount, db
+    from sqlalchemy import func, select
+    import json
+
+    if not messages:
+        return
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    count = len(messages)
+    saved = (select(func.coalesce(func.max(ConversationTurn.turn_index), -1) + 1)
+             .where(ConversationTurn.session_id == session_id)
+             .scalar_subquery())
+    allocate = (insert(ConversationTurnCount)
+                .values(session_id=session_id, count=saved + count)
+                .on_conflict_do_update(index_elements=["session_id"],
+                                       set_={"count": ConversationTurnCount.count + count})
+                .returning(ConversationTurnCount.count))
     try:
-        from data import ExperimentData, db
-        import json
-        
-        if session_id in conversations and conversations[session_id]:
-            # Find existing experiment data or create new
-            experiment_data = ExperimentData.query.filter_by(
-                session_id=session_id, 
-                user_action="ai_conversation"
-            ).first()
-            
-            if not experiment_data:
-                experiment_data = ExperimentData(
-                    session_id=session_id,
-                    user_id=user_id,  # Link to anonymous user
-                    user_action="ai_conversation",
-                    timestamp=datetime.now(),
-                    data=json.dumps({"conversation_started": True})
-                )
-                db.session.add(experiment_data)
-            
-            # Update conversation data and ensure user_id is set
-            if user_id and not experiment_data.user_id:
-                experiment_data.user_id = user_id
-            
-            experiment_data.conversation = json.dumps(conversations[session_id])
-            experiment_data.timestamp = datetime.now()  # Update timestamp
-            db.session.commit()
-            
+        first_index = db.session.execute(allocate).scalar_one() - count
+        now = datetime.now()
+        db.session.add_all([
+            ConversationTurn(
+                session_id=session_id,
+                turn_index=first_index + offset,
+                user_id=user_id,
+                role=message.get("role"),
+                message=json.dumps(message, default=str),
+                timestamp=now
+            )
+            for offset, message in enumerate(messages)
+        ])
+        db.session.commit()
     except Exception as e:
+        db.session.rollback()
         print(f"Error saving conversation to database: {e}")
 
-def get_llm_response(context="", user_message="", session_id="default", user_id=None):
-    # Initialize conversation for new sessions
-    if session_id not in conversations:
-        conversations[session_id] = []
-    
-    print(f"Assistant.py: {user_id}, {session_id}, {user_message}")
+ASSISTANT_INSTRUCTIONS = "You are a JavaScript and Phaser.js coding assistant. You are helping a game developer implement mechanics. Provide clear, working code solutions and explanations."
 
-    # Append user message (no timestamp for OpenAI input)
-    conversations[session_id].append({
-        "role": "user",
-        "content": user_message
-    })
-    
-    # Prepare content for OpenAI (strip timestamps)
-    content = [
-        {"role": m["role"], "content": m["content"]}
-        for m in conversations[session_id] if "role" in m and "content" in m
-    ]
-    
-    
-    
-    
-    response = client.responses.create(
+SUMMARY_INSTRUCTIONS = """You maintain a running summary of a conversation between a game developer and a Phaser.js coding assistant.
+Update the existing summary with the new messages. Keep the developer's goals, decisions, code changes discussed and open questions. Drop pleasantries and repeated code.
+Reply with the updated summary only, in at most 200 words."""
+
+def summarize_conversation(previous_summary, messages):
+    """Fold messages into the previous summary of a conversation"""
+    transcript = "\n\n".join(f"{m.get('role', 'unknown')}: {message_text(m)}" for m in messages)
+    response = create_response(
+        purpose="summary",
         model="gpt-4.1-mini",
-        instructions="You are a JavaScript and Phaser.js coding assistant. You are helping a game developer implement mechanics. Provide clear, working code solutions and explanations.",
-        input=content
+        instructions=SUMMARY_INSTRUCTIONS,
+        input=f"Existing summary:\n{previous_summary or 'None'}\n\nNew messages:\n{transcript}"
     )
+    return response.output_text
+
+# Older turns are folded into a cached per-session summary so each request stays a similar size
+context_window = ContextWindow(
+    store=conversations,
+    summarize=summarize_conversation,
+    count_tokens=lambda text: count_tokens(text),
+    keep_messages=int(os.environ.get("CONTEXT_KEEP_MESSAGES", "8")),
+    fold_batch=int(os.environ.get("CONTEXT_FOLD_BATCH", "6")),
+    token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", "16000"))
+)
+
+def prepare_llm_input(session_id, user_message):
+    """Return the model input for the session's conversation followed by the user message.
+
+    The message is not stored here: callers store it along with the reply, so a turn
+    that was never answered does not stay in the conversation.
+    """
+    # No timestamp for OpenAI input
+    messages = conversations.get(session_id) + [{"role": "user", "content": user_message}]
+    
+    # Prepare content for OpenAI (strip timestamps, summarize older turns)
+    return context_window.build_input(session_id, messages)
+
+def add_turn(session_id, user_message, reply_message, user_id=None):
+    """Store an answered turn: the user message and the assistant message replying to it"""
+    messages = [{"role": "user", "content": user_message}, reply_message]
+    for message in messages:
+        add_message(session_id, message)
+    for hook in turn_hooks:
+        try:
+            hook(session_id, user_id, messages)
+        except Exception as e:
+            print(f"Turn hook failed: {e}")
+
+def response_cache_scope(session_id, condition):
+    """(namespace, code hash) to cache this turn's reply under, or None if it is not cached"""
+    if RESPONSE_CACHE_MODE not in ("first", "any"):
+        return None
+    if RESPONSE_CACHE_MODE == "first" and get_conversation_tokens(session_id) > 0:
+        return None
+    namespace = "chat" if RESPONSE_CACHE_SHARE_CONDITIONS else f"chat:{condition or 'unknown'}"
+    return namespace, code_store.get_with_etag(session_id)[1]
+
+def get_cached_reply(session_id, user_message, scope, user_id=None):
+    """Return a cached reply and record the turn in the conversation, or None on a miss"""
+    if scope is None:
+        return None
+    reply = response_cache.get(scope[0], user_message, scope[1])
+    if reply is not None:
+        print(f"Response cache hit for session {session_id}")
+        add_turn(session_id, user_message, {
+            "role": "assistant",
+            "response": reply,
+            "timestamp": datetime.now().isoformat()
+        }, user_id)
+    return reply
+
+@interactive_calls()
+def get_llm_response(context="", user_message="", session_id="default", user_id=None, condition=None):
+    print(f"Assistant.py: {user_id}, {session_id}, {user_message}")
+
+    cache_scope = response_cache_scope(session_id, condition)
+    cached = get_cached_reply(session_id, user_message, cache_scope, user_id)
+    if cached is not None:
+        return cached
+
+    if llm_breaker.is_open():
+        print(f"AI circuit open, sending degraded reply to session {session_id}")
+        return DEGRADED_REPLY
+
+    content = prepare_llm_input(session_id, user_message)
+    
+    try:
+        response = create_response(
+            purpose="chat",
+            model="gpt-4.1-mini",
+            instructions=ASSISTANT_INSTRUCTIONS,
+            input=content
+        )
+    except CircuitOpenError:
+        print(f"AI circuit open, sending degraded reply to session {session_id}")
+        return DEGRADED_REPLY
     
     # Store conversation in session-specific list (with timestamp for local tracking)
-    conversations[session_id].append({
+    add_turn(session_id, user_message, {
         "role": "assistant",
         "response": response.output_text,
         "timestamp": datetime.now().isoformat()
-    })
-    
-# CHECK RATE LIMITS FROM RESPONSE
-    headers = getattr(response, 'headers', {})
-    requests_left = headers.get('x-ratelimit-remaining-requests', 'Unknown')
-    tokens_left = headers.get('x-ratelimit-remaining-tokens', 'Unknown')    
+    }, user_id)
     
     print(f"Response: {response}")
-    # WARN IF LOW
-    if requests_left != 'Unknown' and int(requests_left) < 10:
-        print("WARNING: Less than 10 requests remaining!")
-    
-    if tokens_left != 'Unknown' and int(tokens_left) < 1000:
-        print("WARNING: Less than 1000 tokens remaining!")
+
+    if cache_scope is not None:
+        response_cache.set(cache_scope[0], user_message, cache_scope[1], response.output_text)
         
     return response.output_text
 
+def stream_llm_response(context="", user_message="", session_id="default", user_id=None, condition=None):
+    """Stream the assistant reply, yielding text deltas as the model produces them"""
+    print(f"Assistant.py (stream): {user_id}, {session_id}, {user_message}")
+
+    cache_scope = response_cache_scope(session_id, condition)
+    cached = get_cached_reply(session_id, user_message, cache_scope, user_id)
+    if cached is not None:
+        yield cached
+        return
+
+    if llm_breaker.is_open():
+        print(f"AI circuit open, sending degraded reply to session {session_id}")
+        yield DEGRADED_REPLY
+        return
+
+    # Set around each call rather than the whole generator, which is resumed between yields
+    with interactive_calls():
+        content = prepare_llm_input(session_id, user_message)
+
+    stream = stream_response(
+        "chat",
+        interactive=True,
+        model="gpt-4.1-mini",
+        instructions=ASSISTANT_INSTRUCTIONS,
+        input=content
+    )
+
+    chunks = []
+    try:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                chunks.append(event.delta)
+                yield event.delta
+            elif event.type == "response.completed":
+                record_usage("chat", getattr(event.response, "usage", None))
+            elif event.type == "error":
+                raise RuntimeError(getattr(event, "message", "Streaming response failed"))
+    except CircuitOpenError:
+        # Only raised before the call is made, so nothing has been sent yet
+        print(f"AI circuit open, sending degraded reply to session {session_id}")
+        yield DEGRADED_REPLY
+        return
+
+    # Store the complete reply once the stream has finished
+    reply = "".join(chunks)
+    add_turn(session_id, user_message, {
+        "role": "assistant",
+        "response": reply,
+        "timestamp": datetime.now().isoformat()
+    }, user_id)
+    if cache_scope is not None:
+        response_cache.set(cache_scope[0], user_message, cache_scope[1], reply)
+
+# Extended-thinking budget: each request stops planning once any of these runs out and
+# answers with what it has gathered so far
+REACT_MAX_STEPS = int(os.environ.get("REACT_MAX_STEPS", "3"))
+REACT_TIME_BUDGET = float(os.environ.get("REACT_TIME_BUDGET", "60"))
+REACT_TOKEN_BUDGET = int(os.environ.get("REACT_TOKEN_BUDGET", "60000"))
+REACT_MIN_CONFIDENCE = float(os.environ.get("REACT_MIN_CONFIDENCE", "0.5"))
+
+react_stats = {"requests": 0, "model_calls": 0, "tool_rounds": 0, "confident": 0, "budget_stops": 0}
+react_stats_lock = threading.Lock()
+
+def count_react(key):
+    with react_stats_lock:
+        react_stats[key] += 1
+
+def response_tokens(response):
+    """Total tokens billed for a model response, or 0 if usage was not reported"""
+    return getattr(getattr(response, "usage", None), "total_tokens", 0) or 0
+
+def parse_final_response(text):
+    """Split generate_final_response output into (answer, confidence)"""
+    answer, marker, confidence = text.rpartition("Confidence:")
+    if not marker:
+        return text.strip(), 0.0
+    try:
+        return answer.strip(), float(confidence.strip())
+    except ValueError:
+        return answer.strip(), 0.0
+
+@interactive_calls()
 def get_react_response(context="", user_message="", session_id="default", user_id=None):
-    # Initialize conversation for new sessions
-    if session_id not in conversations:
-        conversations[session_id] = []
-    
     print(f"Assistant.py: {user_id}, {session_id}, {user_message}")
 
-    # Append user message
-    conversations[session_id].append({
-        "role": "user",
-        "content": user_message
-    })
-    
-    # Calculate total length of all conversation content for this user/session
-    total_token_length = sum(
-        count_tokens(content=msg.get("content", "")) for msg in conversations[session_id] if "content" in msg
-    )
+    if llm_breaker.is_open():
+        print(f"AI circuit open, sending degraded reply to session {session_id}")
+        return DEGRADED_REPLY
+
+    # Running total of conversation content for this user/session, updated as messages are added
+    total_token_length = get_conversation_tokens(session_id) + count_tokens(user_message)
     print(f"Total token length for session {session_id}: {total_token_length}")
     
-    total_token_length = total_token_length + count_tokens(user_message)
-    
     if total_token_length > MAX_TOKENS:
         return {"error": "Your conversation is too long for the AI to process. Please start a new chat using the clear chat button. This will reset the conversation and allow you to continue. If you have any important information, please copy it before clearing the chat."}
     
+    try:
+        final_response, details = run_react(user_message, session_id)
+    except CircuitOpenError:
+        print(f"AI circuit opened, sending degraded reply to session {session_id}")
+        return DEGRADED_REPLY
+        
+    # Store conversation, with the steps taken so they are saved alongside the reply
+    add_turn(session_id, user_message, {
+        "role": "assistant",
+        "response": final_response,
+        **details,
+        "timestamp": datetime.now().isoformat()
+    }, user_id)
+
+    return final_response
+
+def run_react(user_message, session_id):
+    """Run the ReAct loop for a message and return (answer, details of the steps taken)"""
     # Initialize conversation context for this ReAct session
     react_context = [user_message]
-    final_response = None
     accumulated_data = {
         "session_id": session_id,
         "user_message": user_message,
@@ -207,12 +603,33 @@ def get_react_response(context="", user_message="", session_id="default", user_i
         "search_results": None
     }
     
-    # ReAct loop
-    for step in range(3):
+    started_at = time.monotonic()
+    deadline = started_at + REACT_TIME_BUDGET
+    tokens_used = 0
+    steps = []
+    final_response, confidence = None, 0.0
+    # Tool results not yet seen by generate_final_response; without new ones a second answer would repeat the first
+    new_results = True
+    
+    # ReAct loop: reason, run tools, and answer once the tools of a round have finished.
+    # A confident answer ends the loop; a doubtful one gets another round only if it asks for more tools.
+    for step in range(REACT_MAX_STEPS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or tokens_used >= REACT_TOKEN_BUDGET:
+            print(f"ReAct budget spent after {step} steps ({tokens_used} tokens)")
+            count_react("budget_stops")
+            break
         print(f"ReAct Step {step + 1}")
         
         # Get reasoning with accumulated context
-        reasoning_response = reasoning_step(react_context)
+        step_started = time.monotonic()
+        try:
+            reasoning_response = reasoning_step(react_context, timeout=min(llm_pool.timeout, remaining))
+        except TimeoutError as e:
+            print(f"ReAct reasoning stopped: {e}")
+            count_react("budget_stops")
+            break
+        tokens_used += response_tokens(reasoning_response)
         reasoning_text = reasoning_response.output_text
                 
         # Parse tools needed
@@ -222,123 +639,139 @@ def get_react_response(context="", user_message="", session_id="default", user_i
         except IndexError:
             print("No tools section found in reasoning")
             tools_requested = []
+        if not tools_requested or tools_requested[0].lower() in ("", "none"):
+            tools_requested = []
         
-        # Execute tools if any
-        if tools_requested and tools_requested[0]:
-            tool_results = call_tools(tools_requested, accumulated_data)
-            tool_summary = "\n".join([f"Tool: {tool} -> {result[:100]}..." 
-                                    for tool, result in zip(tools_requested, tool_results)])
-                        
-            # Add to context for next iteration
-            react_context.append(f"Reasoning: {reasoning_text}")
-            react_context.append(f"Tool Results: {tool_summary}")
-        else:
-            # No more tools needed, break early
+        if not tools_requested:
+            steps.append({"step": step + 1, "tools": [], "ms": round((time.monotonic() - step_started) * 1000)})
             print("No tools requested, proceeding to final answer")
             break
-    
-        # Generate final response with all context
-        final_response = generate_final_response(
-            user_message, 
-            react_context, 
-            accumulated_data
-        )
         
-        final_response, final_response_confidence = final_response.output_text.split("Confidence:")
-        final_response_confidence = float(final_response_confidence) if final_response_confidence.replace('.', '', 1).isdigit() else 0.0
-        if final_response_confidence < 0.5:
-            print("⚠️ Low confidence in final response, continuing ReAct loop")
-            print(f"Confidence score: {final_response_confidence}")
-            print(f"Final response: {final_response}")
-            continue
-        elif final_response_confidence >= 0.5:
-            print("✅ High confidence in final response, breaking ReAct loop")
+        tool_results, tool_tokens = call_tools(tools_requested, accumulated_data)
+        tokens_used += tool_tokens
+        tool_summary = "\n".join([f"Tool: {tool} -> {result[:100]}..." 
+                                for tool, result in zip(tools_requested, tool_results)])
+        count_react("tool_rounds")
+        steps.append({"step": step + 1, "tools": tools_requested, "ms": round((time.monotonic() - step_started) * 1000)})
+                    
+        # Add to context for next iteration
+        react_context.append(f"Reasoning: {reasoning_text}")
+        react_context.append(f"Tool Results: {tool_summary}")
+        new_results = True
+        
+        if step + 1 == REACT_MAX_STEPS or time.monotonic() >= deadline or tokens_used >= REACT_TOKEN_BUDGET:
+            # No round left to act on a doubtful answer, so answer once after the loop
             break
         
-    # Store conversation
-    conversations[session_id].append({
-        "role": "assistant",
-        "response": final_response,
-        "timestamp": datetime.now().isoformat()
-    })
-    
-    # Check rate limits
-    headers = getattr(final_response, 'headers', {})
-    requests_left = headers.get('x-ratelimit-remaining-requests', 'Unknown')
-    tokens_left = headers.get('x-ratelimit-remaining-tokens', 'Unknown')    
-    
-    print(f"💬 Response: {final_response}")
-    if requests_left != 'Unknown' and int(requests_left) < 10:
-        print("⚠️ WARNING: Less than 10 requests remaining!")
+        final_response, confidence, tokens = answer_react(user_message, react_context, accumulated_data)
+        tokens_used += tokens
+        new_results = False
+        if confidence >= REACT_MIN_CONFIDENCE:
+            print(f"✅ Confident final response ({confidence}), ending ReAct loop")
+            count_react("confident")
+            break
+        print(f"⚠️ Low confidence in final response ({confidence}), continuing ReAct loop")
+        react_context.append(f"Draft answer (confidence {confidence}): {final_response}")
+    
+    if final_response is None or new_results:
+        # Always answer, even past the budget
+        final_response, confidence, tokens = answer_react(user_message, react_context, accumulated_data)
+        tokens_used += tokens
+    
+    elapsed_ms = round((time.monotonic() - started_at) * 1000)
+    print(f"ReAct finished: {len(steps)} steps, tools {[s['tools'] for s in steps]}, "
+          f"confidence {confidence}, {tokens_used} tokens, {elapsed_ms} ms")
+    count_react("requests")
+
+    return final_response, {
+        "react_steps": steps,
+        "react_confidence": confidence,
+        "react_tokens": tokens_used,
+        "react_ms": elapsed_ms
+    }
+
+def answer_react(user_message, react_context, accumulated_data):
+    """Generate the final response, returning (answer, confidence, tokens used)"""
+    response = generate_final_response(user_message, react_context, accumulated_data)
+    count_react("model_calls")
     
-    if tokens_left != 'Unknown' and int(tokens_left) < 1000:
-        print("⚠️ WARNING: Less than 1000 tokens remaining!")
+    answer, confidence = parse_final_response(response.output_text)
+    print(f"💬 Response: {answer}")
+    return answer, confidence, response_tokens(response)
 
-    return final_response
+# Tools that use the results of the other tools requested in the same step
+DEPENDENT_TOOLS = {"generate_code_example"}
+
+def run_tool(tool, accumulated_data):
+    """Execute a single tool, returning its result, the accumulated_data updates it produces and the tokens it used."""
+    if tool == "get_current_code":
+        code = accumulated_data.get("code") or ""
+        return f"Retrieved game code ({len(code)} characters)", {}, 0
+        
+    elif tool == "analyze_code":
+        result, tokens = analyze_code(accumulated_data.get("code"))
+        return result, {"analysis": result}, tokens
+        
+    elif tool.startswith("search_phaser_docs"):
+        # Parse query from tool string
+        if "query:" in tool:
+            query = tool.split("query:")[1].rstrip(")]").strip()
+        else:
+            query = "general phaser documentation"
+        
+        result = search_phaser_docs(query)
+        return result, {"search_results": result}, 0
+        
+    elif tool == "generate_code_example":
+        result, tokens = generate_code_example(accumulated_data)
+        return result, {}, tokens
+        
+    return f"Unknown tool: {tool}", {}, 0
 
 def call_tools(tools, accumulated_data):
-    """Call the specified tools with the given input data."""
-    results = []
+    """Call the specified tools with the given input data.
     
-    for tool in tools:
-        tool = tool.strip()
-        print(f"🔧 Executing tool: {tool}")
-        
+    Independent tools run concurrently; generate_code_example waits for them so it
+    sees the analysis and search results. Returns the results in request order and
+    the tokens the tools' model calls used.
+    """
+    tools = [tool.strip() for tool in tools]
+    results = [None] * len(tools)
+    tokens = [0] * len(tools)
+    
+    # Both tools work on the current code, so read it once before anything runs
+    session_id = accumulated_data.get("session_id", "default")
+    if "get_current_code" in tools or ("analyze_code" in tools and not accumulated_data.get("code")):
+        accumulated_data["code"] = get_gamescript(session_id)
+    
+    independent = [i for i, tool in enumerate(tools) if tool not in DEPENDENT_TOOLS]
+    dependent = [i for i, tool in enumerate(tools) if tool in DEPENDENT_TOOLS]
+    
+    def collect(i, future):
         try:
-            if tool == "get_current_code":
-                result = get_gamescript(accumulated_data.get("session_id", "default"))
-                accumulated_data["code"] = result
-                results.append(f"Retrieved game code ({len(result)} characters)")
-                
-            elif tool == "analyze_code":
-                code = accumulated_data.get("code")
-                if not code:
-                    code = get_gamescript(accumulated_data.get("session_id", "default"))
-                    accumulated_data["code"] = code
-                
-                result = analyze_code(code)
-                accumulated_data["analysis"] = result
-                results.append(result)
-                
-            elif tool.startswith("search_phaser_docs"):
-                # Parse query from tool string
-                if "query:" in tool:
-                    query = tool.split("query:")[1].rstrip(")]").strip()
-                else:
-                    query = "general phaser documentation"
-                
-                result = search_phaser_docs(query)
-                accumulated_data["search_results"] = result
-                results.append(result)
-                
-            elif tool == "generate_code_example":
-                result = generate_code_example(accumulated_data)
-                results.append(result)
-                
-            else:
-                result = f"Unknown tool: {tool}"
-                results.append(result)
-                
+            result, updates, tokens[i] = future.result()
+            accumulated_data.update(updates)
+            results[i] = result
         except Exception as e:
-            error_msg = f"Error executing {tool}: {str(e)}"
+            error_msg = f"Error executing {tools[i]}: {str(e)}"
             print(f"❌ {error_msg}")
-            results.append(error_msg)
+            results[i] = error_msg
     
-    return results
-
-def analyze_code(code):
-    """Analyze the provided code using AI for comprehensive insights."""
+    futures = []
+    for i in independent:
+        print(f"🔧 Executing tool: {tools[i]}")
+        futures.append((i, tool_executor.submit(contextvars.copy_context().run, run_tool, tools[i], dict(accumulated_data))))
+    # Merge in request order so repeated tools resolve the same way every time
+    for i, future in futures:
+        collect(i, future)
     
-    if not code or code.startswith("Error:"):
-        return "No valid code to analyze"
+    for i in dependent:
+        print(f"🔧 Executing tool: {tools[i]}")
+        collect(i, tool_executor.submit(contextvars.copy_context().run, run_tool, tools[i], dict(accumulated_data)))
     
-    # Prepare the analysis prompt
-    prompt = f"""You are a Phaser.js expert analyzing game code. Provide a comprehensive analysis of the following JavaScript/Phaser.js code.
+    return results, sum(tokens)
 
-Code to analyze:
-```javascript
-{code}
-```
+ANALYZE_INSTRUCTIONS = """You are a Phaser.js expert analyzing game code. Provide a comprehensive analysis of the JavaScript/Phaser.js code you are given.
 
 Provide analysis in the following format:
 
@@ -366,17 +799,48 @@ SUGGESTIONS:
 
 Keep the analysis concise but thorough. Focus on practical feedback."""
 
-    response = client.responses.create(
+def analyze_code(code):
+    """Analyze the provided code using AI for comprehensive insights; returns (analysis, tokens used)."""
+    
+    if not code or code.startswith("Error:"):
+        return "No valid code to analyze", 0
+    
+    # Unchanged code with the same prompt gets the same analysis
+    cache_key = content_hash(ANALYZE_PROMPT_VERSION, code)
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        print(f"Analysis cache hit ({analysis_cache.hits} hits, {analysis_cache.misses} misses)")
+        return cached, 0
+
+    response = create_response(
+        purpose="analyze_code",
         model="gpt-4.1-mini",
-        instructions=prompt,
-        input=code
+        instructions=ANALYZE_INSTRUCTIONS,
+        input=f"Code to analyze:\n```javascript\n{code}\n```"
     )
     
-    return f"AI Code Analysis:\n\n{response.output_text}"
+    result = f"AI Code Analysis:\n\n{response.output_text}"
+    analysis_cache.set(cache_key, result)
+    return result, response_tokens(response)
 
 
 
 def search_phaser_docs(query: str) -> str:
+    """Search the bundled Phaser 3 API index, optionally falling back to web search."""
+    
+    matches = phaser_docs.search(query, limit=3)
+    if matches:
+        return f"Phaser.js Documentation for '{query}':\n\n" + "\n\n".join(format_entry(m) for m in matches)
+    
+    if DOCS_WEB_FALLBACK:
+        try:
+            return docs_web_breaker.call(search_phaser_docs_web, query)
+        except CircuitOpenError:
+            print(f"Docs search circuit open, skipping web search for '{query}'")
+    
+    return f"No documentation found for '{query}'. Visit https://phaser.io/docs for complete documentation."
+
+def search_phaser_docs_web(query: str) -> str:
     """Search Phaser.js documentation using web search."""
     
     search_url = "https://api.duckduckgo.com/"
@@ -385,7 +849,7 @@ def search_phaser_docs(query: str) -> str:
         'format': 'json'
     }
     
-    response = requests.get(search_url, params=params, timeout=10)
+    response = requests.get(search_url, params=params, timeout=DOCS_WEB_TIMEOUT)
     data = response.json()
     
     results = []
@@ -404,8 +868,20 @@ def search_phaser_docs(query: str) -> str:
     else:
         return f"No documentation found for '{query}'. Visit https://phaser.io/docs for complete documentation."
 
+CODE_EXAMPLE_INSTRUCTIONS = """You are a Phaser.js expert. Generate a specific, working code example for the user's request, using the context you are given.
+
+Requirements:
+1. Provide ONLY working JavaScript/Phaser.js code
+2. Include clear comments explaining each part
+3. Make the code integrate well with existing code structure
+4. Use Phaser.js best practices
+5. Make it copy-paste ready
+6. If modifying existing code, show the specific changes needed
+
+Generate a practical code example that directly addresses the user's request."""
+
 def generate_code_example(data):
-    """Generate a code example using AI based on accumulated data and user request."""
+    """Generate a code example using AI based on accumulated data and user request; returns (example, tokens used)."""
     
     user_message = data.get("user_message", "")
     current_code = data.get("code", "")
@@ -425,39 +901,18 @@ def generate_code_example(data):
         context_parts.append(f"Documentation findings:\n{search_results}")
     
     context_str = "\n\n".join(context_parts) if context_parts else "No current code context available."
-    
-    prompt = f"""You are a Phaser.js expert. Generate a specific, working code example for the user's request.
-
-User Request: {user_message}
-
-Context:
-{context_str}
 
-Requirements:
-1. Provide ONLY working JavaScript/Phaser.js code
-2. Include clear comments explaining each part
-3. Make the code integrate well with existing code structure
-4. Use Phaser.js best practices
-5. Make it copy-paste ready
-6. If modifying existing code, show the specific changes needed
-
-Generate a practical code example that directly addresses the user's request:"""
-
-    response = client.responses.create(
+    # The game code leads the input so repeated requests on unchanged code share a cached prefix
+    response = create_response(
+        purpose="code_example",
         model="gpt-4.1-mini",
-        instructions=prompt,
-        input=user_message
+        instructions=CODE_EXAMPLE_INSTRUCTIONS,
+        input=f"Context:\n{context_str}\n\nUser Request: {user_message}"
     )
 
-    return f"AI-generated code example:\n\n{response.output_text}"
+    return f"AI-generated code example:\n\n{response.output_text}", response_tokens(response)
 
-def reasoning_step(context_list):
-    """Perform reasoning step with accumulated context."""
-    
-    # Join context into a single string
-    context_str = "\n\n".join(context_list)
-    
-    prompt = f"""You are the reasoning step of a Reasoning and Action agent. Your job is to analyze the user's request and determine the best course of action. You will not execute any actions, but will provide a clear reasoning for the next step.
+REASONING_INSTRUCTIONS = """You are the reasoning step of a Reasoning and Action agent. Your job is to analyze the user's request and determine the best course of action. You will not execute any actions, but will provide a clear reasoning for the next step. The input is the context from previous steps, starting with the user's request.
 
 Available tools:
 - get_current_code: Get user's current game code
@@ -465,33 +920,27 @@ Available tools:
 - search_phaser_docs(query:[search term]): Find Phaser.js documentation 
 - generate_code_example: Create code examples for features
 
-Context from previous steps:
-{context_str}
-
 Format your response as follows:
 Reasoning: [Use this section as a scratchpad for your reasoning]
 Identify: [Try to identify the user's intent max 1 sentence] 
 Tools_needed: [List the tools you need to use in order, separated by commas. If no more tools needed, write "none"]"""
 
-    response = client.responses.create(
+def reasoning_step(context_list, timeout=None):
+    """Perform reasoning step with accumulated context."""
+    
+    response = create_response(
+        purpose="reasoning",
         model="gpt-4.1-mini",
-        instructions=prompt,
-        input=context_str
+        instructions=REASONING_INSTRUCTIONS,
+        input="\n\n".join(context_list),
+        timeout=timeout or llm_pool.timeout
     )
+    count_react("model_calls")
     
     return response
 
 
-def generate_final_response(user_message, context_list, accumulated_data):
-    """Generate the final response based on accumulated context and user message."""
-    
-    # Join context into a single string
-    context_str = "\n\n".join(context_list)
-    
-    prompt = f"""You are the final response generator of a Reasoning and Action agent. Your job is to provide a clear, concise answer to the user's request based on the accumulated context.
-Context from previous steps:
-{context_str}
-User Request: {user_message}
+FINAL_RESPONSE_INSTRUCTIONS = """You are the final response generator of a Reasoning and Action agent. Your job is to provide a clear, concise answer to the user's request based on the accumulated context you are given.
 
 Generate a final response that summarizes the reasoning and provides a clear answer to the user's request. If code was generated, include it in the response.
 
@@ -499,16 +948,26 @@ Format your response as follows:
 Final Response: [Your final answer here]
 Confidence: [Your confidence in the answer from 0 to 1.0, where 1 is very confident]"""
 
-    response = client.responses.create(
+def generate_final_response(user_message, context_list, accumulated_data):
+    """Generate the final response based on accumulated context and user message."""
+    
+    # Context grows by appending, so earlier rounds' context stays a cacheable prefix
+    context_str = "\n\n".join(context_list)
+    
+    response = create_response(
+        purpose="final_response",
         model="gpt-4.1-mini",
-        instructions=prompt,
-        input=context_str
+        instructions=FINAL_RESPONSE_INSTRUCTIONS,
+        input=f"Context from previous steps:\n{context_str}\n\nUser Request: {user_message}"
     )
     
-    
     return response
 
+@lru_cache(maxsize=None)
+def get_encoding():
+    """Load the tokenizer once; building it is far slower than encoding a message"""
+    return tiktoken.get_encoding("o200k_base")
+
 def count_tokens(content=""):
-    encoding = tiktoken.get_encoding("o200k_base")
-    tokens = encoding.encode(content)
+    tokens = get_encoding().encode(content)
     return len(tokens)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a backend whose breaker is open"""
+
+
+class CircuitBreaker:
+    """Fails calls to a struggling backend fast instead of letting them pile up.
+
+    Closed: calls go through. After failure_threshold consecutive calls that either
+    failed or took longer than slow_call seconds, the breaker opens and calls raise
+    CircuitOpenError straight away. After reset_timeout seconds it is half-open: one
+    trial call goes through, and the breaker closes if that call is healthy or opens
+    again if not.
+    """
+
+    def __init__(self, name, failure_threshold=5, slow_call=10.0, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return self._state
+
+    def is_open(self):
+        """True while calls would be rejected; does not take the half-open trial call"""
+        with self._lock:
+            if self._state == "open":
+                return time.monotonic() - self._opened_at < self.reset_timeout
+            return self._state == "half_open" and self._trial_in_flight
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go to the backend now"""
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = "half_open"
+                self._trial_in_flight = False
+            if self._state == "open" or (self._state == "half_open" and self._trial_in_flight):
+                self._stats["rejected"] += 1
+                raise CircuitOpenError(f"The {self.name} service is not responding, please try again shortly")
+            if self._state == "half_open":
+                self._trial_in_flight = True
+            self._stats["calls"] += 1
+
+    def record_success(self, elapsed):
+        """Record a call that returned after elapsed seconds; a slow one counts as a failure"""
+        if elapsed > self.slow_call:
+            with self._lock:
+                self._stats["slow_calls"] += 1
+            print(f"{self.name} call took {elapsed:.1f}s")
+            self._fail()
+            return
+        with self._lock:
+            if self._state != "closed":
+                print(f"{self.name} circuit closed")
+            self._state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._stats["failures"] += 1
+        self._fail()
+
+    def release(self):
+        """Forget a call that ended without telling whether the backend is healthy"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def _fail(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._stats["opened"] += 1
+                    print(f"{self.name} circuit opened after {self._failures} failed or slow calls")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn through the breaker, timing it and recording the outcome"""
+        self.allow()
+        started_at = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success(time.monotonic() - started_at)
+        return result
+
+    def metrics(self):
+        state = self.state
+        with self._lock:
+            stats = dict(self._stats)
+            stats["consecutive_failures"] = self._failures
+        stats["state"] = state
+        return stats
+
+
+def create_breaker_from_env(name, prefix, failure_threshold=5, slow_call=10.0, reset_timeout=30.0):
+    """Build a breaker from <prefix>_BREAKER_FAILURES, <prefix>_BREAKER_SLOW_CALL and <prefix>_BREAKER_RESET"""
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get(f"{prefix}_BREAKER_FAILURES", str(failure_threshold))),
+        slow_call=float(os.environ.get(f"{prefix}_BREAKER_SLOW_CALL", str(slow_call))),
+        reset_timeout=float(os.environ.get(f"{prefix}_BREAKER_RESET", str(reset_timeout))),
+    )
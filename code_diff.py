@@ -0,0 +1,194 @@
+"""
+Line diff engine for save-code.
+
+Produces unified diffs in the same format as difflib.unified_diff(a, b, lineterm='')
+and counts added/removed lines while emitting them. Common prefixes and suffixes
+are matched directly; what is left is split on lines that occur exactly once on
+both sides (patience diff) and the gaps between them are diffed with Myers'
+O(ND) algorithm, so typical small edits to a large file cost little more than
+comparing the lines once.
+"""
+
+# Myers gives up on a region once the edit distance passes this and treats it as replaced
+MAX_EDIT_COST = 500
+
+
+def _myers(a, b, alo, ahi, blo, bhi, matches):
+    """Append the matching (i, j) line pairs of a shortest edit script, or return False if too costly"""
+    n, m = ahi - alo, bhi - blo
+    max_d = min(n + m, MAX_EDIT_COST)
+    v = {1: 0}
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                found = []
+                for step in range(d, -1, -1):
+                    prev = trace[step]
+                    k = x - y
+                    if k == -step or (k != step and prev[k - 1] < prev[k + 1]):
+                        prev_k = k + 1
+                    else:
+                        prev_k = k - 1
+                    prev_x = prev[prev_k]
+                    prev_y = prev_x - prev_k
+                    while x > prev_x and y > prev_y:
+                        x -= 1
+                        y -= 1
+                        found.append((alo + x, blo + y))
+                    x, y = prev_x, prev_y
+                matches.extend(reversed(found))
+                return True
+    return False
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    """Lines occurring once on each side, in an order increasing on both (longest such chain)"""
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.setdefault(a[i], [0, i, 0, 0])
+        entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted((e[1], e[3]) for e in counts.values() if e[0] == 1 and e[2] == 1)
+    if not pairs:
+        return []
+    # Longest increasing subsequence on the b index (patience sorting)
+    tails, tail_index, previous = [], [], [None] * len(pairs)
+    for idx, (_, j) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < j:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(tails):
+            tails.append(j)
+            tail_index.append(idx)
+        else:
+            tails[lo] = j
+            tail_index[lo] = idx
+        previous[idx] = tail_index[lo - 1] if lo > 0 else None
+    chain = []
+    idx = tail_index[-1]
+    while idx is not None:
+        chain.append(pairs[idx])
+        idx = previous[idx]
+    chain.reverse()
+    return chain
+
+
+def _match(a, b, alo, ahi, blo, bhi, matches):
+    # Common prefix and suffix are matched without any search
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    suffix = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        suffix.append((ahi, bhi))
+    if alo < ahi and blo < bhi:
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            for i, j in anchors:
+                _match(a, b, alo, i, blo, j, matches)
+                matches.append((i, j))
+                alo, blo = i + 1, j + 1
+            _match(a, b, alo, ahi, blo, bhi, matches)
+        else:
+            _myers(a, b, alo, ahi, blo, bhi, matches)
+    matches.extend(reversed(suffix))
+
+
+def get_opcodes(a, b):
+    """difflib-style (tag, i1, i2, j1, j2) opcodes turning a into b"""
+    matches = []
+    _match(a, b, 0, len(a), 0, len(b), matches)
+    opcodes = []
+    i = j = 0
+    for mi, mj in matches + [(len(a), len(b))]:
+        if i < mi or j < mj:
+            tag = "replace" if i < mi and j < mj else ("delete" if i < mi else "insert")
+            opcodes.append([tag, i, mi, j, mj])
+        if mi < len(a) and mj < len(b):
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1][2] += 1
+                opcodes[-1][4] += 1
+            else:
+                opcodes.append(["equal", mi, mi + 1, mj, mj + 1])
+        i, j = mi + 1, mj + 1
+    return [tuple(op) for op in opcodes]
+
+
+def _grouped(opcodes, n):
+    """Split opcodes into hunks with n lines of context, as difflib.get_grouped_opcodes does"""
+    codes = list(opcodes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(a, b, n=3):
+    """Return (diff lines, lines added, lines removed) for line lists a and b.
+
+    The diff lines are formatted like difflib.unified_diff(a, b, lineterm='') and
+    are empty when a and b are equal.
+    """
+    lines = []
+    added = removed = 0
+    for group in _grouped(get_opcodes(a, b), n):
+        if not lines:
+            lines.append("--- ")
+            lines.append("+++ ")
+        first, last = group[0], group[-1]
+        lines.append(f"@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend(" " + line for line in a[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                lines.extend("-" + line for line in a[i1:i2])
+                removed += i2 - i1
+            if tag in ("replace", "insert"):
+                lines.extend("+" + line for line in b[j1:j2])
+                added += j2 - j1
+    return lines, added, removed
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import re
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+
+# A full copy of the code is stored every KEYFRAME_INTERVAL revisions; the rest are diffs
+KEYFRAME_INTERVAL = int(os.environ.get("CODE_KEYFRAME_INTERVAL", "20"))
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class RevisionError(Exception):
+    """Raised when a revision cannot be rebuilt from the stored history"""
+
+
+def code_hash(code):
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+def is_keyframe(revision):
+    return revision % KEYFRAME_INTERVAL == 0
+
+
+def build_revision(model, revision, prev_code, code, diff, keyframe=None, **columns):
+    """Create a CodeRevision row: the full code on keyframes, otherwise the diff from prev_code"""
+    if keyframe is None:
+        keyframe = is_keyframe(revision)
+    return model(
+        revision=revision,
+        is_keyframe=keyframe,
+        content=code if keyframe else "\n".join(diff),
+        code_hash=code_hash(code),
+        base_hash=None if keyframe else code_hash(prev_code),
+        timestamp=datetime.now(),
+        **columns
+    )
+
+
+def store_revision(db, model, session_id, prev_code, code, diff, attempts=5, **columns):
+    """Insert the next revision of a session's code and return its number.
+
+    The number is MAX(revision) + 1 of the stored rows; if a concurrent save takes it
+    first, the unique index rejects the insert and the number is allocated again. The row is a full keyframe on the usual interval, and also whenever the
+    latest stored revision is not prev_code (a save from another tab, or one that was
+    never written), so a diff is only stored on top of a revision known to exist.
+    """
+    base_hash = code_hash(prev_code)
+    for _ in range(attempts):
+        latest = (db.session.query(model.revision, model.code_hash)
+                  .filter(model.session_id == session_id)
+                  .order_by(model.revision.desc())
+                  .first())
+        revision = latest.revision + 1 if latest else 0
+        keyframe = is_keyframe(revision) or latest is None or latest.code_hash != base_hash
+        db.session.add(build_revision(model, revision, prev_code, code, diff, keyframe=keyframe,
+                                      session_id=session_id, **columns))
+        try:
+            db.session.commit()
+            return revision
+        except IntegrityError:
+            db.session.rollback()
+    raise RevisionError(f"Could not allocate a revision for session {session_id}")
+
+
+def apply_unified_diff(old_code, diff_text):
+    """Apply a unified diff of '\\n'-split lines (as produced for save-code) to old_code"""
+    old_lines = old_code.split("\n") if old_code else []
+    new_lines = []
+    position = 0  # Index of the next unconsumed old line
+    lines = diff_text.split("\n") if diff_text else []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if line.startswith("---") or line.startswith("+++"):
+            continue
+        header = _HUNK_HEADER.match(line)
+        if not header:
+            raise RevisionError(f"Unexpected line in diff: {line[:80]!r}")
+        old_start = int(header.group(1))
+        old_count = int(header.group(2)) if header.group(2) is not None else 1
+        new_count = int(header.group(4)) if header.group(4) is not None else 1
+        # An empty old range is positioned after line old_start rather than at it
+        hunk_start = old_start if old_count == 0 else old_start - 1
+        if hunk_start < position:
+            raise RevisionError("Overlapping hunks in diff")
+        new_lines.extend(old_lines[position:hunk_start])
+        position = hunk_start
+        remaining_old, remaining_new = old_count, new_count
+        while remaining_old > 0 or remaining_new > 0:
+            if i >= len(lines):
+                raise RevisionError("Diff ended inside a hunk")
+            body = lines[i]
+            i += 1
+            tag, text = body[:1], body[1:]
+            if tag in (" ", "-"):
+                if position >= len(old_lines) or old_lines[position] != text:
+                    raise RevisionError(f"Diff does not match base code at line {position + 1}")
+                position += 1
+                remaining_old -= 1
+                if tag == " ":
+                    new_lines.append(text)
+                    remaining_new -= 1
+            elif tag == "+":
+                new_lines.append(text)
+                remaining_new -= 1
+            else:
+                raise RevisionError(f"Unexpected line in hunk: {body[:80]!r}")
+    new_lines.extend(old_lines[position:])
+    return "\n".join(new_lines)
+
+
+def rebuild_revision(model, session_id, revision=None):
+    """Rebuild the code of a session at revision (the latest if None) from its history"""
+    query = model.query.filter(model.session_id == session_id)
+    if revision is not None:
+        query = query.filter(model.revision <= revision)
+    keyframe = query.filter(model.is_keyframe.is_(True)).order_by(model.revision.desc()).first()
+    if keyframe is None:
+        raise RevisionError(f"No keyframe stored for session {session_id}")
+    code = keyframe.content
+    deltas = query.filter(model.revision > keyframe.revision).order_by(model.revision).all()
+    for row in deltas:
+        if row.base_hash and row.base_hash != code_hash(code):
+            raise RevisionError(f"Revision {row.revision} of {session_id} does not follow revision {row.revision - 1}")
+        code = apply_unified_diff(code, row.content)
+        if code_hash(code) != row.code_hash:
+            raise RevisionError(f"Revision {row.revision} of {session_id} rebuilt with the wrong content")
+    if revision is not None and (deltas[-1].revision if deltas else keyframe.revision) != revision:
+        raise RevisionError(f"Revision {revision} of {session_id} is missing")
+    return code
@@ -0,0 +1,285 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from cache import TTLCache, content_hash
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BASE_DIR, "static", "js", "game.js")
+
+
+class LocalDirCodeBackend:
+    """One game_<session>.js file per session in a directory.
+
+    Files are written to a temporary name and renamed into place, so readers in
+    other worker processes never see a partly written script.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"game_{session_id}.js")
+
+    def version(self, session_id):
+        try:
+            stat = os.stat(self._path(session_id))
+        except FileNotFoundError:
+            return None
+        # Every write renames a new file into place, so the inode changes with each save
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def read(self, session_id):
+        try:
+            with open(self._path(session_id), "r", encoding="utf-8") as f:
+                stat = os.fstat(f.fileno())
+                return f.read(), (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def write(self, session_id, code):
+        path = self._path(session_id)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8", newline='') as f:
+                f.write(code)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.version(session_id)
+
+    def delete(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteCodeBackend:
+    """Session code as BLOB rows in a SQLite file, shared by every worker process on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS code_file (
+                    session_id TEXT PRIMARY KEY,
+                    content BLOB NOT NULL,
+                    version INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """)
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def version(self, session_id):
+        row = self._connect().execute(
+            "SELECT version FROM code_file WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def read(self, session_id):
+        row = self._connect().execute(
+            "SELECT content, version FROM code_file WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return (row[0].decode("utf-8"), row[1]) if row else None
+
+    def write(self, session_id, code):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO code_file (session_id, content, version, updated_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET content = excluded.content, "
+                "version = code_file.version + 1, updated_at = excluded.updated_at",
+                (session_id, code.encode("utf-8"), time.time())
+            )
+            return conn.execute("SELECT version FROM code_file WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def delete(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM code_file WHERE session_id = ?", (session_id,))
+
+
+class CodeStore:
+    """Per-session game code over a backend, with one shared in-memory template.
+
+    Sessions are copy-on-write: until a session saves, it reads the template and
+    nothing is stored for it.
+
+    Loaded code is cached with its split lines and served from memory while the
+    backend still reports the same version, so saves by other workers are picked up.
+    With write_delay=0 saves are written through. With write_delay > 0 they are held
+    in memory and written back by a background thread after that many seconds, so a
+    burst of saves costs one write; this only suits a single worker process, since
+    other workers see the old code until the write lands.
+    """
+
+    def __init__(self, backend, template_path=TEMPLATE_PATH, max_sessions=500, ttl=7200, write_delay=0.0):
+        self.backend = backend
+        self.template_path = template_path
+        self.write_delay = write_delay
+        self._cache = TTLCache(max_size=max_sessions, ttl=ttl)
+        self._template = None
+        self._pending = {}  # session_id -> (code, lines, etag) not yet written to the backend
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+        self._stats = {"reads": 0, "writes": 0, "deferred_writes": 0}
+        atexit.register(self.flush)
+
+    def template(self):
+        """The game.js template, read from disk once"""
+        return self._load_template()[0]
+
+    def _load_template(self):
+        if self._template is None:
+            with open(self.template_path, "r", encoding="utf-8") as f:
+                code = f.read()
+            self._template = (code, code.split('\n') if code else [], content_hash(code))
+        return self._template
+
+    def _entry(self, session_id):
+        """(code, lines, etag) saved for the session, or None"""
+        with self._lock:
+            pending = self._pending.get(session_id)
+        if pending is not None:
+            return pending
+        version = self.backend.version(session_id)
+        if version is None:
+            self._cache.pop(session_id)
+            return None
+        cached = self._cache.get(session_id)
+        if cached is not None and cached[0] == version:
+            return cached[1:]
+        stored = self.backend.read(session_id)
+        if stored is None:
+            return None
+        code, version = stored
+        entry = (code, code.split('\n') if code else [], content_hash(code))
+        self._cache.set(session_id, (version,) + entry)
+        with self._lock:
+            self._stats["reads"] += 1
+        return entry
+
+    def load(self, session_id):
+        """Return (code, lines) saved for the session, or None if nothing was saved"""
+        entry = self._entry(session_id)
+        return entry[:2] if entry is not None else None
+
+    def get(self, session_id):
+        """The session's code, or None if nothing was saved"""
+        entry = self.load(session_id)
+        return entry[0] if entry is not None else None
+
+    def load_or_template(self, session_id):
+        """Return (code, lines) for the session, or the template's if it has not saved yet"""
+        entry = self.load(session_id)
+        if entry is None:
+            code, lines, _ = self._load_template()
+            return code, lines
+        return entry
+
+    def get_or_template(self, session_id):
+        """Return (code, is_template): sessions read the shared template until their first save"""
+        code = self.get(session_id)
+        if code is None:
+            return self.template(), True
+        return code, False
+
+    def get_with_etag(self, session_id):
+        """Return (code, strong ETag) for the session, or for the template if it has not saved yet"""
+        entry = self._entry(session_id)
+        if entry is None:
+            entry = self._load_template()
+        return entry[0], entry[2]
+
+    def save(self, session_id, code, lines=None):
+        if lines is None:
+            lines = code.split('\n') if code else []
+        if self.write_delay > 0:
+            with self._lock:
+                self._pending[session_id] = (code, lines, content_hash(code))
+                self._stats["deferred_writes"] += 1
+            self._ensure_flusher()
+            return
+        self._write(session_id, code, lines, content_hash(code))
+
+    def _write(self, session_id, code, lines, etag):
+        version = self.backend.write(session_id, code)
+        self._cache.set(session_id, (version, code, lines, etag))
+        with self._lock:
+            self._stats["writes"] += 1
+
+    def delete(self, session_id):
+        with self._lock:
+            self._pending.pop(session_id, None)
+        self._cache.pop(session_id)
+        self.backend.delete(session_id)
+
+    def flush(self):
+        """Write every held save to the backend"""
+        with self._lock:
+            pending = dict(self._pending)
+        for session_id, entry in pending.items():
+            with self._lock:
+                if self._pending.get(session_id) is not entry:
+                    continue  # Deleted since
+            try:
+                self._write(session_id, *entry)
+            except Exception as e:
+                print(f"Error writing code for session {session_id}: {e}")
+                continue
+            with self._lock:
+                # Kept until written so reads never fall back to the older backend copy
+                if self._pending.get(session_id) is entry:
+                    del self._pending[session_id]
+
+    def _ensure_flusher(self):
+        # Started lazily so each forked worker process gets its own flusher thread
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive() and self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(target=self._run_flusher, name="code-store-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.write_delay)
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats["cache"] = self._cache.stats()
+        return stats
+
+
+def create_code_store_from_env():
+    """Build the code store selected by CODE_STORE.
+
+    A directory path (default static/js/users) or sqlite:///path/to/file.db.
+    """
+    url = os.environ.get("CODE_STORE", os.path.join(BASE_DIR, "static", "js", "users"))
+    if url.startswith("sqlite:///"):
+        backend = SQLiteCodeBackend(url[len("sqlite:///"):])
+    else:
+        backend = LocalDirCodeBackend(url)
+    return CodeStore(
+        backend,
+        max_sessions=int(os.environ.get("CODE_STORE_CACHE_SIZE", "500")),
+        ttl=float(os.environ.get("CODE_STORE_CACHE_TTL", "7200")),
+        write_delay=float(os.environ.get("CODE_STORE_WRITE_DELAY", "0"))
+    )
@@ -0,0 +1,64 @@
+class ContextWindow:
+    """Keeps the model input for a conversation within a fixed size.
+
+    The most recent messages are sent verbatim. Older messages are folded into a
+    running summary kept in the conversation store's session metadata. The summary
+    is regenerated only once fold_batch more messages have aged out (or the verbatim
+    window exceeds token_budget), so the per-turn input stays roughly constant
+    however long the session runs.
+    """
+
+    def __init__(self, store, summarize, count_tokens, keep_messages=8, fold_batch=6, token_budget=16000):
+        self.store = store
+        self.summarize = summarize
+        self.count_tokens = count_tokens
+        self.keep_messages = keep_messages
+        self.fold_batch = fold_batch
+        self.token_budget = token_budget
+
+    def _tokens(self, messages):
+        return sum(self.count_tokens(message_text(m)) for m in messages)
+
+    def _fold_point(self, messages, folded):
+        """Index up to which messages should be folded into the summary, or folded if none"""
+        pending = len(messages) - folded
+        if pending <= self.keep_messages:
+            return folded
+        end = folded
+        if pending >= self.keep_messages + self.fold_batch:
+            end = len(messages) - self.keep_messages
+        # Fold further while the verbatim window is still over budget, keeping the newest message
+        while end < len(messages) - 1 and self._tokens(messages[end:]) > self.token_budget:
+            end += 1
+        return end
+
+    def build_input(self, session_id, messages):
+        """Return the model input for messages: summary of older turns plus recent turns"""
+        # Stored with the conversation as [number of messages folded, summary text]
+        folded, summary = self.store.get_meta(session_id, "summary", [0, ""])
+        if folded > len(messages):
+            # Conversation was cleared or replaced since the summary was made
+            folded, summary = 0, ""
+
+        end = self._fold_point(messages, folded)
+        if end > folded:
+            try:
+                summary = self.summarize(summary, messages[folded:end])
+                folded = end
+                self.store.set_meta(session_id, "summary", [folded, summary])
+            except Exception as e:
+                print(f"Could not summarize conversation for {session_id}, sending it verbatim: {e}")
+
+        content = []
+        if summary:
+            content.append({"role": "developer", "content": f"Summary of the earlier conversation:\n{summary}"})
+        content.extend(
+            {"role": m["role"], "content": m["content"]}
+            for m in messages[folded:] if "role" in m and "content" in m
+        )
+        return content
+
+
+def message_text(message):
+    """Text of a stored message; assistant replies keep theirs under 'response'"""
+    return message.get("content") or message.get("response") or ""
@@ -0,0 +1,292 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryConversationStore:
+    """In-process conversation store with LRU eviction, idle expiry and a memory cap.
+
+    Memory use is tracked as the size of each message serialized to JSON, which is
+    close to what the messages cost to hold and to send.
+    """
+
+    def __init__(self, max_sessions=1000, idle_ttl=6 * 3600, max_bytes=256 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()  # session_id -> {"messages", "meta", "bytes", "last_access"}
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def _touch(self, session_id, create=False):
+        entry = self._sessions.get(session_id)
+        if entry is not None and self.idle_ttl is not None and time.monotonic() - entry["last_access"] > self.idle_ttl:
+            self._drop(session_id)
+            self._evictions += 1
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = {"messages": [], "meta": {}, "bytes": 0}
+            self._sessions[session_id] = entry
+        entry["last_access"] = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return entry
+
+    def _drop(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry["bytes"]
+
+    def _evict(self):
+        # Sessions are kept in access order, so idle and least recently used ones are at the front
+        now = time.monotonic()
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            idle = self.idle_ttl is not None and now - entry["last_access"] > self.idle_ttl
+            if not idle and len(self._sessions) <= self.max_sessions and self._bytes <= self.max_bytes:
+                break
+            if len(self._sessions) == 1 and not idle:
+                break  # Never evict the session that is being written to
+            self._drop(session_id)
+            self._evictions += 1
+
+    def get(self, session_id, start=0):
+        with self._lock:
+            entry = self._touch(session_id)
+            return entry["messages"][start:] if entry else []
+
+    def append(self, session_id, message):
+        size = len(json.dumps(message, default=str))
+        with self._lock:
+            entry = self._touch(session_id, create=True)
+            entry["messages"].append(message)
+            entry["bytes"] += size
+            self._bytes += size
+            self._evict()
+
+    def get_meta(self, session_id, key, default=None):
+        with self._lock:
+            entry = self._touch(session_id)
+            return entry["meta"].get(key, default) if entry else default
+
+    def set_meta(self, session_id, key, value):
+        with self._lock:
+            self._touch(session_id, create=True)["meta"][key] = value
+
+    def clear(self, session_id):
+        with self._lock:
+            self._drop(session_id)
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "evictions": self._evictions,
+            }
+
+
+class SQLiteConversationStore:
+    """Conversation store in a SQLite file, shared by every worker process on the host.
+
+    Sessions idle for longer than idle_ttl are removed, and the least recently used
+    sessions are removed once there are more than max_sessions.
+    """
+
+    def __init__(self, path, max_sessions=10000, idle_ttl=6 * 3600, sweep_interval=60):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        with self._connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS conversation_session (
+                    session_id TEXT PRIMARY KEY,
+                    last_access REAL NOT NULL,
+                    bytes INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS ix_conversation_session_last_access ON conversation_session (last_access);
+                CREATE TABLE IF NOT EXISTS conversation_message (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    message TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_conversation_message_session ON conversation_message (session_id, id);
+                CREATE TABLE IF NOT EXISTS conversation_meta (
+                    session_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (session_id, key)
+                );
+            """)
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    def _touch(self, conn, session_id, added_bytes=0):
+        conn.execute(
+            "INSERT INTO conversation_session (session_id, last_access, bytes) VALUES (?, ?, ?) "
+            "ON CONFLICT(session_id) DO UPDATE SET last_access = excluded.last_access, bytes = bytes + excluded.bytes",
+            (session_id, time.time(), added_bytes)
+        )
+
+    def _sweep(self, conn):
+        now = time.time()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        stale = [row[0] for row in conn.execute(
+            "SELECT session_id FROM conversation_session WHERE last_access < ?", (now - self.idle_ttl,)
+        )]
+        overflow = conn.execute("SELECT COUNT(*) FROM conversation_session").fetchone()[0] - len(stale) - self.max_sessions
+        if overflow > 0:
+            stale += [row[0] for row in conn.execute(
+                "SELECT session_id FROM conversation_session WHERE last_access >= ? ORDER BY last_access LIMIT ?",
+                (now - self.idle_ttl, overflow)
+            )]
+        for session_id in stale:
+            self._delete(conn, session_id)
+
+    def _delete(self, conn, session_id):
+        conn.execute("DELETE FROM conversation_message WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM conversation_meta WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM conversation_session WHERE session_id = ?", (session_id,))
+
+    def get(self, session_id, start=0):
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT message FROM conversation_message WHERE session_id = ? ORDER BY id LIMIT -1 OFFSET ?",
+            (session_id, start)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append(self, session_id, message):
+        payload = json.dumps(message, default=str)
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT INTO conversation_message (session_id, message) VALUES (?, ?)", (session_id, payload))
+            self._touch(conn, session_id, len(payload))
+            self._sweep(conn)
+
+    def get_meta(self, session_id, key, default=None):
+        row = self._connect().execute(
+            "SELECT value FROM conversation_meta WHERE session_id = ? AND key = ?", (session_id, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, session_id, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO conversation_meta (session_id, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id, key) DO UPDATE SET value = excluded.value",
+                (session_id, key, json.dumps(value))
+            )
+            self._touch(conn, session_id)
+
+    def clear(self, session_id):
+        conn = self._connect()
+        with conn:
+            self._delete(conn, session_id)
+
+    def __contains__(self, session_id):
+        return self._connect().execute(
+            "SELECT 1 FROM conversation_session WHERE session_id = ?", (session_id,)
+        ).fetchone() is not None
+
+    def stats(self):
+        sessions, total_bytes = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM conversation_session"
+        ).fetchone()
+        return {"backend": "sqlite", "sessions": sessions, "bytes": total_bytes}
+
+
+class RedisConversationStore:
+    """Conversation store on a Redis server (or anything speaking the same commands).
+
+    Each session is a list of JSON messages plus a hash of metadata, both expiring
+    after idle_ttl seconds without activity. Redis' own maxmemory policy bounds
+    memory, so max_sessions is not enforced here.
+    """
+
+    def __init__(self, client, idle_ttl=6 * 3600, prefix="conversation"):
+        self.client = client
+        self.idle_ttl = idle_ttl
+        self.prefix = prefix
+
+    def _keys(self, session_id):
+        return f"{self.prefix}:{session_id}:messages", f"{self.prefix}:{session_id}:meta"
+
+    def _touch(self, session_id):
+        for key in self._keys(session_id):
+            self.client.expire(key, int(self.idle_ttl))
+
+    def get(self, session_id, start=0):
+        messages_key, _ = self._keys(session_id)
+        return [json.loads(item) for item in self.client.lrange(messages_key, start, -1)]
+
+    def append(self, session_id, message):
+        messages_key, _ = self._keys(session_id)
+        self.client.rpush(messages_key, json.dumps(message, default=str))
+        self._touch(session_id)
+
+    def get_meta(self, session_id, key, default=None):
+        _, meta_key = self._keys(session_id)
+        value = self.client.hget(meta_key, key)
+        return json.loads(value) if value is not None else default
+
+    def set_meta(self, session_id, key, value):
+        _, meta_key = self._keys(session_id)
+        self.client.hset(meta_key, key, json.dumps(value))
+        self._touch(session_id)
+
+    def clear(self, session_id):
+        self.client.delete(*self._keys(session_id))
+
+    def __contains__(self, session_id):
+        messages_key, meta_key = self._keys(session_id)
+        return bool(self.client.exists(messages_key) or self.client.exists(meta_key))
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+def create_store_from_env():
+    """Build the conversation store selected by CONVERSATION_STORE.
+
+    memory (default), sqlite:///path/to/file.db or redis://host:port/db.
+    """
+    url = os.environ.get("CONVERSATION_STORE", "memory")
+    max_sessions = int(os.environ.get("CONVERSATION_MAX_SESSIONS", "1000"))
+    idle_ttl = float(os.environ.get("CONVERSATION_IDLE_TTL", str(6 * 3600)))
+    if url.startswith("sqlite:///"):
+        return SQLiteConversationStore(url[len("sqlite:///"):], max_sessions=max_sessions, idle_ttl=idle_ttl)
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(f"CONVERSATION_STORE={url} needs the redis package (pip install redis)")
+        return RedisConversationStore(redis.Redis.from_url(url), idle_ttl=idle_ttl)
+    return MemoryConversationStore(
+        max_sessions=max_sessions,
+        idle_ttl=idle_ttl,
+        max_bytes=int(os.environ.get("CONVERSATION_MAX_BYTES", str(256 * 1024 * 1024)))
+    )
@@ -0,0 +1,145 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+
+class CPUPoolFullError(RuntimeError):
+    """Raised when no worker process frees up within the queue timeout"""
+
+
+class CPUTimeoutError(TimeoutError):
+    """Raised when a task does not finish within its deadline"""
+
+
+class CPUPool:
+    """Bounded process pool for CPU-heavy request work (script parsing, diffing).
+
+    Tasks run in worker processes so they do not hold the GIL of the request
+    worker. At most `workers` tasks run at once and a task is only submitted when a
+    process is free, so its deadline measures run time rather than queueing; callers
+    wait up to queue_timeout for a free process. A task that misses its deadline has
+    its process killed: the pool is replaced and tasks that were running beside it
+    are retried once on the new pool. With workers=0 tasks run inline.
+
+    Workers are started with forkserver (spawn where that is unavailable) rather than
+    fork: the web process already runs other threads, and a forked child can deadlock
+    on a lock one of them held. The forkserver imports the preload modules once, so
+    workers start with them loaded.
+    """
+
+    def __init__(self, workers=2, timeout=5.0, queue_timeout=10.0, start_method=None, preload=()):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.start_method = start_method
+        self.preload = list(preload)
+        self._slots = threading.BoundedSemaphore(max(workers, 1))
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "rejected": 0,
+            "recycled": 0,
+            "inline": 0,
+            "total_run_ms": 0.0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _submit(self, fn, args):
+        with self._lock:
+            # Created lazily so each forked web worker gets its own processes
+            if self._executor is None or self._pid != os.getpid():
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == "forkserver" and self.preload:
+                    context.set_forkserver_preload(self.preload)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            self._stats["submitted"] += 1
+            return self._executor, self._executor.submit(fn, *args)
+
+    def _recycle(self, executor):
+        """Kill the processes of executor and let the next task start a fresh pool"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._stats["recycled"] += 1
+        terminate = getattr(executor, "terminate_workers", None)
+        if terminate is not None:
+            terminate()
+        else:
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, fn, *args, timeout=None):
+        """Run a picklable module-level fn in a worker process and return its result"""
+        if self.workers <= 0:
+            self._count("inline")
+            return fn(*args)
+        deadline = timeout or self.timeout
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._count("rejected")
+            raise CPUPoolFullError("The server is busy checking code, please try again shortly")
+        try:
+            for attempt in range(2):
+                started_at = time.monotonic()
+                executor, future = None, None
+                try:
+                    executor, future = self._submit(fn, args)
+                    result = future.result(timeout=deadline)
+                except FutureTimeoutError:
+                    self._count("timed_out")
+                    # The worker cannot be interrupted, only killed
+                    self._recycle(executor)
+                    raise CPUTimeoutError(f"{getattr(fn, '__name__', 'task')} did not finish within {deadline}s")
+                except BrokenProcessPool:
+                    # Killed along with a task that timed out (or crashed); retry once
+                    if executor is not None:
+                        self._recycle(executor)
+                    if attempt:
+                        self._count("failed")
+                        raise
+                    continue
+                except Exception:
+                    self._count("failed")
+                    raise
+                finally:
+                    self._count("total_run_ms", (time.monotonic() - started_at) * 1000)
+                self._count("completed")
+                return result
+        finally:
+            self._slots.release()
+
+    def metrics(self):
+        """Snapshot of pool counters, including average task run time"""
+        with self._lock:
+            stats = dict(self._stats)
+        finished = stats["completed"] + stats["failed"] + stats["timed_out"]
+        stats["avg_run_ms"] = round(stats["total_run_ms"] / finished, 2) if finished else 0.0
+        stats["workers"] = self.workers
+        stats["start_method"] = self.start_method
+        return stats
+
+
+def create_cpu_pool_from_env(preload=()):
+    """Build the shared pool from CPU_POOL_WORKERS, CPU_TASK_TIMEOUT, CPU_QUEUE_TIMEOUT and CPU_POOL_START_METHOD"""
+    return CPUPool(
+        workers=int(os.environ.get("CPU_POOL_WORKERS", "2")),
+        timeout=float(os.environ.get("CPU_TASK_TIMEOUT", "5")),
+        queue_timeout=float(os.environ.get("CPU_QUEUE_TIMEOUT", "10")),
+        start_method=os.environ.get("CPU_POOL_START_METHOD") or None,
+        preload=preload,
+    )
@@ -54,6 +54,17 @@ class User(db.Model):
     expertise_level = db.Column(db.String(100), nullable=True)  # e.g., Beginner, Intermediate, Advanced
     signed_date = db.Column(db.DateTime, default=datetime.utcnow)  # Date when user signed up
 
+    __table_args__ = (
+        # Counting participants per group when ConditionCount is seeded
+        db.Index('ix_user_expertise_condition', 'expertise_level', 'assigned_condition'),
+    )
+
+class ConditionCount(db.Model):
+    """Participants assigned to each condition per expertise level, incremented with each new User"""
+    expertise_level = db.Column(db.String(100), primary_key=True)
+    assigned_condition = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
 class Survey(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(100), nullable=False)  # Link to user session
@@ -88,6 +99,11 @@ class Survey(db.Model):
     
     description = db.Column(db.String(1000))
 
+    __table_args__ = (
+        db.Index('ix_survey_user_id', 'user_id'),
+        db.Index('ix_survey_session_id', 'session_id'),
+    )
+
 class ExperimentData(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -98,13 +114,22 @@ class ExperimentData(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     data = db.Column(db.Text)  # JSON string for additional data
 
+    __table_args__ = (
+        # Actions of a session by type (e.g. its conversation), and a participant's timeline
+        db.Index('ix_experiment_data_session_action', 'session_id', 'user_action'),
+        db.Index('ix_experiment_data_user_timestamp', 'user_id', 'timestamp'),
+    )
+
 class CodeChange(db.Model):
     edit_id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     participant_code = db.Column(db.String(80), nullable=False)  # Unique code for user
     
-    code_before = db.Column(db.Text, nullable=False)
-    code_after = db.Column(db.Text, nullable=False)
+    # Full before/after text is no longer written; the code is rebuilt from CodeRevision
+    code_before = db.Column(db.Text, nullable=True)
+    code_after = db.Column(db.Text, nullable=True)
+    session_id = db.Column(db.String(100), nullable=True)
+    revision = db.Column(db.Integer, nullable=True)  # CodeRevision.revision this change produced
     
     lines_changed = db.Column(db.Integer, nullable=False)
     lines_added = db.Column(db.Integer, nullable=False)
@@ -112,6 +137,49 @@ class CodeChange(db.Model):
     
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_code_change_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_code_change_session_revision', 'session_id', 'revision'),
+    )
+
+class CodeRevision(db.Model):
+    """One saved version of a participant's game.js, as a keyframe or a diff from the previous one"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    participant_code = db.Column(db.String(80), nullable=False)  # Unique code for user
+    session_id = db.Column(db.String(100), nullable=False)
+    revision = db.Column(db.Integer, nullable=False)  # 0, 1, 2... within the session
+    is_keyframe = db.Column(db.Boolean, nullable=False, default=False)
+    content = db.Column(db.Text, nullable=False)  # Full code for keyframes, unified diff otherwise
+    code_hash = db.Column(db.String(64), nullable=False)  # sha256 of the code at this revision
+    base_hash = db.Column(db.String(64), nullable=True)  # sha256 of the code the diff applies to
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # One row per revision; code_history.rebuild_revision walks a session's revisions in order
+        db.Index('uq_code_revision_session_revision', 'session_id', 'revision', unique=True),
+    )
+
+class ConversationTurn(db.Model):
+    """One message of an assistant conversation; rows are only ever appended"""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(100), nullable=False)
+    turn_index = db.Column(db.Integer, nullable=False)  # Position of the message in the session's conversation
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    role = db.Column(db.String(20), nullable=True)
+    message = db.Column(db.Text, nullable=False)  # The message as JSON
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Two saves can never store different turns at the same position
+        db.Index('uq_conversation_turn_session_turn', 'session_id', 'turn_index', unique=True),
+    )
+
+class ConversationTurnCount(db.Model):
+    """Turn indexes allocated to each session's conversation; the next turn_index is count"""
+    session_id = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
 class TaskCheck(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -119,6 +187,11 @@ class TaskCheck(db.Model):
     session_id = db.Column(db.String(100), nullable=False)
     task_id = db.Column(db.String(50), nullable=False)  # e.g., 'task1', 'task2', etc.
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_task_check_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_task_check_session_task', 'session_id', 'task_id'),
+    )
     
 class SUS(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -136,4 +209,9 @@ class SUS(db.Model):
     q8_cumbersome_to_use = db.Column(db.Integer, nullable=False)
     q9_felt_confident = db.Column(db.Integer, nullable=False)
     q10_learn_lot_before_use = db.Column(db.Integer, nullable=False)
-    submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_sus_user_id', 'user_id'),
+        db.Index('ix_sus_session_id', 'session_id'),
+    )
@@ -0,0 +1,69 @@
+import json
+import math
+import re
+from collections import Counter, defaultdict
+
+DEFAULT_DOCS_PATH = "docs/phaser3_api.json"
+
+# Split identifiers like setCollideWorldBounds / Phaser.Physics.Arcade into search terms
+_WORD_PATTERN = re.compile(r"[A-Za-z][a-z]+|[A-Z]+(?![a-z])|\d+")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "for", "from", "how",
+    "i", "if", "in", "is", "it", "make", "my", "of", "on", "or", "so", "the", "this",
+    "to", "use", "with", "e", "g", "phaser",
+}
+
+
+def tokenize(text):
+    """Lower-cased search terms, splitting camelCase and dotted names"""
+    return [w.lower() for w in _WORD_PATTERN.findall(text or "") if w.lower() not in STOPWORDS]
+
+
+class DocsIndex:
+    """In-memory BM25 index over the bundled Phaser 3 API summaries."""
+
+    def __init__(self, entries, k1=1.5, b=0.75):
+        self.entries = entries
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)  # term -> [(doc index, term frequency)]
+        self.doc_lengths = []
+        for doc_id, entry in enumerate(entries):
+            # The name is repeated so matches on the API name outrank passing mentions
+            terms = tokenize(entry.get("name", "")) * 2 + tokenize(entry.get("signature", "")) + tokenize(entry.get("description", ""))
+            self.doc_lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                self.postings[term].append((doc_id, freq))
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+        total = len(entries)
+        self.idf = {
+            term: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    @classmethod
+    def load(cls, path=DEFAULT_DOCS_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f).get("entries", []))
+
+    def search(self, query, limit=3):
+        """Return up to limit entries ranked by BM25 score for query"""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id, freq in self.postings[term]:
+                norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length
+                scores[doc_id] += idf * freq * (self.k1 + 1) / (freq + self.k1 * norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self.entries[doc_id] for doc_id, _ in ranked[:limit]]
+
+
+def format_entry(entry):
+    """Render a docs entry as plain text for the ReAct context"""
+    lines = [f"{entry['name']} ({entry.get('kind', 'api')})", f"  {entry.get('signature', '')}", f"  {entry.get('description', '')}"]
+    if entry.get("example"):
+        lines.append(f"  Example: {entry['example']}")
+    return "\n".join(lines)
@@ -0,0 +1,179 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+
+class _Call:
+    """A write that needs more than an insert, run on the writer thread in queue order"""
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+
+class EventWriter:
+    """Background writer for experiment telemetry rows.
+
+    Routes enqueue model instances instead of committing them inline. A daemon thread
+    collects them and writes each batch with a single add_all/commit once batch_size
+    rows are waiting or flush_interval seconds have passed. Writes that must read the
+    database first (e.g. allocating a revision number) are queued as calls; the thread
+    runs them one at a time after the rows queued before them, so a session's writes
+    land in the order its requests made them. When the queue is full the caller waits
+    up to put_timeout and then writes inline, so a slow database slows requests down
+    rather than growing the queue without bound. Pending writes are made on interpreter
+    shutdown.
+    """
+
+    def __init__(self, app, db, batch_size=100, flush_interval=1.0, max_queue=10000, put_timeout=0.5):
+        self.app = app
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "batches": 0, "calls": 0, "inline_writes": 0, "failed": 0}
+        atexit.register(self.stop)
+
+    def _ensure_started(self):
+        # Started lazily so each forked worker process gets its own writer thread
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+                self._thread.start()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def enqueue(self, row):
+        """Queue a model instance to be inserted by the background writer"""
+        self._ensure_started()
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+            self._count("enqueued")
+        except queue.Full:
+            # Back-pressure: the writer is behind, so this request pays for its own insert
+            self._count("inline_writes")
+            self._write([row])
+
+    def enqueue_call(self, fn, *args):
+        """Queue fn(*args) to run with an app context on the writer thread; fn commits its own writes"""
+        call = _Call(fn, args)
+        self._ensure_started()
+        try:
+            self._queue.put(call, timeout=self.put_timeout)
+            self._count("enqueued")
+        except queue.Full:
+            self._count("inline_writes")
+            self._call(call)
+
+    def _call(self, call):
+        with self.app.app_context():
+            try:
+                call.fn(*call.args)
+                self._count("calls")
+            except Exception as e:
+                self.db.session.rollback()
+                print(f"Error in queued write {getattr(call.fn, '__name__', 'call')}: {e}")
+                self._count("failed")
+
+    def _commit(self, rows):
+        with self.app.app_context():
+            try:
+                self.db.session.add_all(rows)
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                raise
+
+    def _write(self, rows):
+        try:
+            self._commit(rows)
+            self._count("written", len(rows))
+            self._count("batches")
+        except Exception as e:
+            if len(rows) == 1:
+                print(f"Error writing experiment event: {e}")
+                self._count("failed")
+                return
+            # One bad row fails the whole batch, so retry them one at a time
+            print(f"Error writing batch of {len(rows)} experiment events, retrying individually: {e}")
+            for row in rows:
+                self._write([row])
+
+    def _write_batch(self, batch):
+        self._write(batch)
+        for _ in batch:
+            self._queue.task_done()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                row = self._queue.get(timeout=timeout)
+                if isinstance(row, _Call):
+                    # Rows queued before the call are written first, keeping queue order
+                    if batch:
+                        self._write_batch(batch)
+                        batch = []
+                        deadline = None
+                    self._call(row)
+                    self._queue.task_done()
+                else:
+                    batch.append(row)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+            except queue.Empty:
+                pass
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or self._stopping.is_set()):
+                self._write_batch(batch)
+                batch = []
+                deadline = None
+            if self._stopping.is_set() and not batch and self._queue.empty():
+                return
+
+    def flush(self, timeout=None):
+        """Block until every queued row has been written (or timeout seconds pass)"""
+        end = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if end is not None and time.monotonic() >= end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout=10):
+        """Write everything still queued and stop the writer thread"""
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+
+def create_event_writer(app, db):
+    """Build the writer from EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL and EVENT_MAX_QUEUE"""
+    return EventWriter(
+        app,
+        db,
+        batch_size=int(os.environ.get("EVENT_BATCH_SIZE", "100")),
+        flush_interval=float(os.environ.get("EVENT_FLUSH_INTERVAL", "1.0")),
+        max_queue=int(os.environ.get("EVENT_MAX_QUEUE", "10000")),
+    )
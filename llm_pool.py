@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class LLMPoolFullError(RuntimeError):
+    """Raised when too many LLM calls are already waiting for a slot"""
+
+
+class LLMTimeoutError(TimeoutError):
+    """Raised when an LLM call does not finish within its deadline"""
+
+
+_STREAM_DONE = object()
+
+
+class LLMPool:
+    """Bounded execution pool for outgoing LLM calls.
+
+    At most max_in_flight calls run against the API at once; further calls wait
+    in a queue of up to max_queue entries and are rejected beyond that. Every call
+    has a deadline, and queueing/latency counters are available from metrics().
+
+    This caps concurrency; it does not free the caller. call() and stream() block the
+    calling request thread until the pool thread is done, so each chat holds a
+    request thread and, once it is running, a pool thread. Serving more participants
+    than there are request threads would need an async server and client.
+    """
+
+    def __init__(self, max_in_flight=8, max_queue=64, timeout=60):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "timed_out": 0,
+            "rejected": 0,
+            "in_flight": 0,
+            "queued": 0,
+            "max_queued": 0,
+            "total_wait_ms": 0.0,
+            "total_run_ms": 0.0,
+        }
+
+    def _track(self, fn, enqueued_at):
+        """Wrap fn so queue wait and run time are recorded when a worker picks it up"""
+        def run(*args, **kwargs):
+            started_at = time.monotonic()
+            with self._lock:
+                self._stats["queued"] -= 1
+                self._stats["in_flight"] += 1
+                self._stats["total_wait_ms"] += (started_at - enqueued_at) * 1000
+            try:
+                result = fn(*args, **kwargs)
+                with self._lock:
+                    self._stats["completed"] += 1
+                return result
+            except Exception:
+                with self._lock:
+                    self._stats["failed"] += 1
+                raise
+            finally:
+                with self._lock:
+                    self._stats["in_flight"] -= 1
+                    self._stats["total_run_ms"] += (time.monotonic() - started_at) * 1000
+        return run
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn for execution and return a Future"""
+        with self._lock:
+            if self._stats["queued"] >= self.max_queue:
+                self._stats["rejected"] += 1
+                raise LLMPoolFullError("Too many AI requests are waiting, please try again shortly")
+            self._stats["submitted"] += 1
+            self._stats["queued"] += 1
+            self._stats["max_queued"] = max(self._stats["max_queued"], self._stats["queued"])
+        return self._executor.submit(self._track(fn, time.monotonic()), *args, **kwargs)
+
+    def result(self, future, timeout=None):
+        """Wait for a submitted call, raising LLMTimeoutError once the deadline passes"""
+        try:
+            return future.result(timeout=timeout or self.timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                # Never started, so it is no longer counted as queued
+                with self._lock:
+                    self._stats["queued"] -= 1
+            with self._lock:
+                self._stats["timed_out"] += 1
+            raise LLMTimeoutError(f"AI request did not complete within {timeout or self.timeout}s")
+
+    def call(self, fn, *args, timeout=None, **kwargs):
+        """Run fn in the pool and block until it returns or times out"""
+        return self.result(self.submit(fn, *args, **kwargs), timeout)
+
+    def stream(self, fn, *args, timeout=None, **kwargs):
+        """Run a streaming call in the pool, yielding its events in the caller.
+
+        The pool slot is held until the stream is exhausted; timeout applies to the
+        gap between consecutive events rather than the whole stream.
+        """
+        events = queue.Queue()
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for event in fn(*args, **kwargs):
+                    if cancelled.is_set():
+                        break
+                    events.put(event)
+            except Exception as e:
+                events.put(e)
+            finally:
+                events.put(_STREAM_DONE)
+
+        self.submit(produce)
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=timeout or self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats["timed_out"] += 1
+                    raise LLMTimeoutError(f"AI stream stalled for more than {timeout or self.timeout}s")
+                if event is _STREAM_DONE:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            cancelled.set()
+
+    def metrics(self):
+        """Snapshot of pool counters, including average queue wait and run time"""
+        with self._lock:
+            stats = dict(self._stats)
+        finished = stats["completed"] + stats["failed"]
+        stats["avg_wait_ms"] = round(stats["total_wait_ms"] / finished, 2) if finished else 0.0
+        stats["avg_run_ms"] = round(stats["total_run_ms"] / finished, 2) if finished else 0.0
+        stats["max_in_flight"] = self.max_in_flight
+        return stats
+
+
+def create_pool_from_env():
+    """Build the shared pool from LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE and LLM_REQUEST_TIMEOUT"""
+    return LLMPool(
+        max_in_flight=int(os.environ.get("LLM_MAX_IN_FLIGHT", "8")),
+        max_queue=int(os.environ.get("LLM_MAX_QUEUE", "64")),
+        timeout=float(os.environ.get("LLM_REQUEST_TIMEOUT", "60")),
+    )
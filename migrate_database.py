@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Schema migrations for an existing PostgreSQL database
+Run this script after deploying a change to data.py; every step is idempotent.
+With --check-plans it then EXPLAINs the hot lookups and fails if one does not use its index;
+test_query_plans.py checks the same lookups against a SQLite schema built from the models
+"""
+from sqlalchemy import text
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Each migration is a name and the statements it runs, applied in order
+MIGRATIONS = [
+    ("code_history_revisions", [
+        "ALTER TABLE code_change ALTER COLUMN code_before DROP NOT NULL",
+        "ALTER TABLE code_change ALTER COLUMN code_after DROP NOT NULL",
+        "ALTER TABLE code_change ADD COLUMN IF NOT EXISTS session_id VARCHAR(100)",
+        "ALTER TABLE code_change ADD COLUMN IF NOT EXISTS revision INTEGER",
+    ]),
+    ("balanced_condition_counts", [
+        # The condition_count table itself is created by db.create_all()
+        'CREATE INDEX IF NOT EXISTS ix_user_expertise_condition ON "user" (expertise_level, assigned_condition)',
+    ]),
+    ("experiment_table_indexes", [
+        "CREATE INDEX IF NOT EXISTS ix_experiment_data_session_action ON experiment_data (session_id, user_action)",
+        "CREATE INDEX IF NOT EXISTS ix_experiment_data_user_timestamp ON experiment_data (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_code_change_user_timestamp ON code_change (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_code_change_session_revision ON code_change (session_id, revision)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_code_revision_session_revision ON code_revision (session_id, revision)",
+        "CREATE INDEX IF NOT EXISTS ix_task_check_user_timestamp ON task_check (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS ix_task_check_session_task ON task_check (session_id, task_id)",
+        "CREATE INDEX IF NOT EXISTS ix_survey_user_id ON survey (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_survey_session_id ON survey (session_id)",
+        "CREATE INDEX IF NOT EXISTS ix_sus_user_id ON sus (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_sus_session_id ON sus (session_id)",
+    ]),
+]
+
+# Hot lookups and the index each is expected to use; every index declared in data.py has one
+HOT_QUERIES = [
+    ("ix_experiment_data_session_action",
+     "SELECT * FROM experiment_data WHERE session_id = :session_id AND user_action = :action"),
+    ("ix_experiment_data_user_timestamp",
+     "SELECT * FROM experiment_data WHERE user_id = :user_id ORDER BY timestamp"),
+    ("ix_code_change_user_timestamp",
+     "SELECT * FROM code_change WHERE user_id = :user_id ORDER BY timestamp"),
+    ("ix_code_change_session_revision",
+     "SELECT * FROM code_change WHERE session_id = :session_id ORDER BY revision"),
+    ("uq_code_revision_session_revision",
+     "SELECT * FROM code_revision WHERE session_id = :session_id AND revision <= :revision ORDER BY revision"),
+    ("uq_conversation_turn_session_turn",
+     "SELECT * FROM conversation_turn WHERE session_id = :session_id ORDER BY turn_index"),
+    ("ix_task_check_user_timestamp",
+     "SELECT * FROM task_check WHERE user_id = :user_id ORDER BY timestamp"),
+    ("ix_task_check_session_task",
+     "SELECT * FROM task_check WHERE session_id = :session_id AND task_id = :task_id"),
+    ("ix_survey_user_id",
+     "SELECT * FROM survey WHERE user_id = :user_id"),
+    ("ix_survey_session_id",
+     "SELECT * FROM survey WHERE session_id = :session_id"),
+    ("ix_sus_user_id",
+     "SELECT * FROM sus WHERE user_id = :user_id"),
+    ("ix_sus_session_id",
+     "SELECT * FROM sus WHERE session_id = :session_id"),
+    ("ix_user_expertise_condition",
+     'SELECT assigned_condition, COUNT(id) FROM "user" WHERE expertise_level = :level GROUP BY assigned_condition'),
+]
+HOT_QUERY_PARAMS = {"session_id": "session_x", "action": "conversation", "user_id": 1, "revision": 10,
+                    "level": "low", "task_id": "task_1"}
+
+def query_plan(conn, query):
+    """The planner's plan for query as text, on PostgreSQL or SQLite"""
+    explain = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    rows = conn.execute(text(explain + query), HOT_QUERY_PARAMS).fetchall()
+    return "\n".join(" ".join(str(value) for value in row) for row in rows)
+
+def migrate():
+    """Create missing tables, then apply every migration step"""
+    from application import application, db
+    try:
+        with application.app_context():
+            # New tables (e.g. code_revision) are created from the models
+            db.create_all()
+            for name, statements in MIGRATIONS:
+                print(f"Applying migration: {name}")
+                with db.engine.begin() as conn:
+                    for statement in statements:
+                        conn.execute(text(statement))
+            return True
+    except Exception as e:
+        print(f"Error migrating database: {e}")
+        return False
+
+def check_query_plans():
+    """EXPLAIN each hot lookup and report whether it uses its index"""
+    from application import application, db
+    failures = []
+    with application.app_context():
+        with db.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Small tables are cheaper to scan, so make the planner show whether the index is usable
+                conn.execute(text("SET LOCAL enable_seqscan = off"))
+            for index_name, query in HOT_QUERIES:
+                plan = query_plan(conn, query)
+                uses_index = index_name in plan
+                print(f"{'OK  ' if uses_index else 'SCAN'} {index_name}")
+                if not uses_index:
+                    print("     " + plan.replace("\n", "\n     "))
+                    failures.append(index_name)
+    return not failures
+
+if __name__ == "__main__":
+    if migrate():
+        print("\nDatabase migration completed successfully!")
+    else:
+        print("\nDatabase migration failed")
+        sys.exit(1)
+    if "--check-plans" in sys.argv and not check_query_plans():
+        print("\nSome lookups do not use their index")
+        sys.exit(1)
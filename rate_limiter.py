@@ -0,0 +1,196 @@
+import os
+import random
+import re
+import threading
+import time
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class RateLimitWaitError(TimeoutError):
+    """Raised when a call cannot be scheduled within the rate limiter's wait limit"""
+
+
+def parse_reset(value):
+    """Seconds in a header value such as '1s', '6m0s', '20ms' or '0.5', or None"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _UNITS[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """Client-side pacing of API calls made with one shared key.
+
+    Requests and tokens are two token buckets that refill continuously at the
+    per-minute limits. The x-ratelimit-limit-* and x-ratelimit-remaining-* headers of
+    every response reset them, so other processes using the key are accounted for.
+    Interactive calls may use the whole bucket. Background calls leave
+    background_reserve of it free and wait while any interactive call is waiting.
+    A rate-limited (429) response pauses every caller for its retry delay: the
+    provider's retry-after hint, or exponential backoff with full jitter.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, background_reserve=0.1,
+                 max_wait=30.0, max_retries=4, base_delay=0.5, max_delay=20.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.background_reserve = background_reserve
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._interactive_waiting = 0
+        self._condition = threading.Condition()
+        self._stats = {
+            "acquired": 0,
+            "waited": 0,
+            "total_wait_ms": 0.0,
+            "rejected": 0,
+            "rate_limited": 0,
+            "retries": 0,
+        }
+
+    def _refill(self, now):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def _delay(self, tokens, interactive, now):
+        """Seconds until a call of this size may start, or 0 if it may start now"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if not interactive and self._interactive_waiting:
+            return 0.05
+        reserve = 0.0 if interactive else self.background_reserve
+        request_floor = 1 + reserve * self.requests_per_minute
+        token_floor = tokens + reserve * self.tokens_per_minute
+        waits = [0.0]
+        if self._requests < request_floor:
+            waits.append((request_floor - self._requests) * 60 / self.requests_per_minute)
+        if self._tokens < token_floor:
+            waits.append((token_floor - self._tokens) * 60 / self.tokens_per_minute)
+        return max(waits)
+
+    def acquire(self, tokens, interactive=True):
+        """Block until a call of about `tokens` tokens may start, then take it from the buckets"""
+        # A call larger than the bucket could never start, so it only waits for a full one
+        reserve = 0.0 if interactive else self.background_reserve
+        tokens = min(tokens, self.tokens_per_minute * (1 - reserve))
+        started_at = time.monotonic()
+        give_up_at = started_at + self.max_wait
+        waited = False
+        with self._condition:
+            if interactive:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    delay = self._delay(tokens, interactive, now)
+                    if delay <= 0:
+                        break
+                    if now + delay > give_up_at:
+                        self._stats["rejected"] += 1
+                        raise RateLimitWaitError("The AI service is busy, please try again shortly")
+                    waited = True
+                    self._condition.wait(delay)
+            finally:
+                if interactive:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+            self._requests -= 1
+            self._tokens -= tokens
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waited"] += 1
+                self._stats["total_wait_ms"] += (time.monotonic() - started_at) * 1000
+
+    def update(self, headers):
+        """Take the provider's view of the limits and what is left from response headers"""
+        if not headers:
+            return
+        with self._condition:
+            self._refill(time.monotonic())
+            limit = headers.get("x-ratelimit-limit-requests")
+            if limit and limit.isdigit() and int(limit) > 0:
+                self.requests_per_minute = int(limit)
+            limit = headers.get("x-ratelimit-limit-tokens")
+            if limit and limit.isdigit() and int(limit) > 0:
+                self.tokens_per_minute = int(limit)
+            remaining = headers.get("x-ratelimit-remaining-requests")
+            if remaining and remaining.isdigit():
+                self._requests = float(remaining)
+                if int(remaining) < 10:
+                    print("WARNING: Less than 10 requests remaining!")
+            remaining = headers.get("x-ratelimit-remaining-tokens")
+            if remaining and remaining.isdigit():
+                self._tokens = float(remaining)
+                if int(remaining) < 1000:
+                    print("WARNING: Less than 1000 tokens remaining!")
+            self._condition.notify_all()
+
+    def retry_delay(self, attempt, headers=None, rate_limited=True):
+        """Seconds to wait before retry number attempt (from 0) of a failed call.
+
+        A rate-limited response also pauses every other caller for that long.
+        """
+        headers = headers or {}
+        delay = parse_reset(headers.get("retry-after-ms"))
+        if delay is not None:
+            delay /= 1000
+        else:
+            delay = parse_reset(headers.get("retry-after"))
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        else:
+            # Spread out callers that were all given the same hint
+            delay += random.uniform(0, self.base_delay)
+        with self._condition:
+            self._stats["retries"] += 1
+            if rate_limited:
+                self._stats["rate_limited"] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                # The provider has nothing left for now, so calls resume at the refill rate
+                self._requests = min(self._requests, 0.0)
+                self._tokens = min(self._tokens, 0.0)
+        return delay
+
+    def metrics(self):
+        """Snapshot of limiter counters and the current bucket levels"""
+        with self._condition:
+            self._refill(time.monotonic())
+            stats = dict(self._stats)
+            stats["requests_available"] = round(self._requests, 1)
+            stats["tokens_available"] = round(self._tokens)
+            stats["requests_per_minute"] = self.requests_per_minute
+            stats["tokens_per_minute"] = self.tokens_per_minute
+        stats["avg_wait_ms"] = round(stats["total_wait_ms"] / stats["waited"], 2) if stats["waited"] else 0.0
+        return stats
+
+
+def create_rate_limiter_from_env():
+    """Build the limiter from the RATE_LIMIT_* variables.
+
+    RATE_LIMIT_RPM and RATE_LIMIT_TPM are only starting points; the response headers
+    replace them after the first call.
+    """
+    return RateLimiter(
+        requests_per_minute=int(os.environ.get("RATE_LIMIT_RPM", "500")),
+        tokens_per_minute=int(os.environ.get("RATE_LIMIT_TPM", "200000")),
+        background_reserve=float(os.environ.get("RATE_LIMIT_BACKGROUND_RESERVE", "0.1")),
+        max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", "30")),
+        max_retries=int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "4")),
+    )
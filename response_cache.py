@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from cache import content_hash
+
+# Words in any script, and runs of other symbols such as operators
+_TOKEN = re.compile(r"\w+|[^\w\s]+")
+# Punctuation that only shapes the sentence; operators and brackets are kept
+_PROSE_PUNCTUATION = frozenset(".,;:!?'\"`¿¡…“”‘’«»")
+
+
+def normalize_prompt(prompt):
+    """Case-fold the prompt and keep its words and code symbols, one space apart.
+
+    Sentence punctuation is dropped, so 'How do I jump?' and 'how do i jump' match,
+    while 'x += 1' and 'x -= 1' do not.
+    """
+    text = unicodedata.normalize("NFKC", prompt or "").casefold()
+    return " ".join(token for token in _TOKEN.findall(text) if not set(token) <= _PROSE_PUNCTUATION)
+
+
+def _ngrams(text, n):
+    padded = f" {text} "
+    return frozenset(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+
+
+class ResponseCache:
+    """Assistant replies to repeated questions, bounded by entry count and reply size.
+
+    Entries are keyed on (namespace, normalized prompt, code hash); the namespace keeps
+    e.g. study conditions apart. With similarity > 0, a miss on the exact key falls back
+    to the most similar prompt in the same namespace and code hash, measured as the
+    Jaccard similarity of character n-grams, if it reaches that threshold. Least
+    recently used entries are evicted first, and entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=8 * 1024 * 1024, ttl=24 * 3600, similarity=0.0, ngram=3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.similarity = similarity
+        self.ngram = ngram
+        self._entries = OrderedDict()  # key -> (reply, bucket, ngrams, expires_at)
+        self._buckets = {}  # (namespace, code_hash) -> set of keys, for the similarity tier
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, namespace, prompt, code_hash):
+        text = normalize_prompt(prompt)
+        if not text:
+            # Nothing left to tell prompts apart, so they must not share a reply
+            return None
+        key = content_hash(namespace, text, code_hash)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[0]
+            if self.similarity > 0:
+                grams = _ngrams(text, self.ngram)
+                best_key, best_score = None, self.similarity
+                for candidate in list(self._buckets.get((namespace, code_hash), ())):
+                    candidate_entry = self._live(candidate, now)
+                    if candidate_entry is None:
+                        continue
+                    other = candidate_entry[2]
+                    score = len(grams & other) / len(grams | other)
+                    if score >= best_score:
+                        best_key, best_score = candidate, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self._stats["similar_hits"] += 1
+                    return self._entries[best_key][0]
+            self._stats["misses"] += 1
+            return None
+
+    def set(self, namespace, prompt, code_hash, reply):
+        if len(reply) > self.max_bytes:
+            return
+        text = normalize_prompt(prompt)
+        if not text:
+            return
+        key = content_hash(namespace, text, code_hash)
+        bucket = (namespace, code_hash)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            grams = _ngrams(text, self.ngram) if self.similarity > 0 else None
+            self._entries[key] = (reply, bucket, grams, time.monotonic() + self.ttl)
+            self._buckets.setdefault(bucket, set()).add(key)
+            self._bytes += len(reply)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[3] <= now:
+            self._drop(key)
+            return None
+        return entry
+
+    def _drop(self, key):
+        reply, bucket, _, _ = self._entries.pop(key)
+        self._bytes -= len(reply)
+        keys = self._buckets.get(bucket)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._buckets[bucket]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        return stats
+
+
+def create_response_cache_from_env():
+    """Build the cache from RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL and RESPONSE_CACHE_SIMILARITY"""
+    return ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", "1000")),
+        max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600))),
+        similarity=float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0")),
+    )
@@ -1,40 +1,350 @@
+import os
 import re
-import esprima  
+from bisect import bisect_right
+import esprima
+from esprima.nodes import Node
+from cache import TTLCache, content_hash
+from code_diff import get_opcodes
+
+# Calls that are rejected when found in the parsed script
+DANGEROUS_CALLS = {'eval', 'Function'}
+
+# A pattern match has at most this many non-blank lines on either side of a chunk boundary
+BOUNDARY_LINES = 5
+# Changed class members are reparsed on their own inside this wrapper class
+MEMBER_WRAPPER = "class __Region extends Object {"
+# Statements that end at their closing brace, so nothing after them can continue them
+BRACE_TERMINATED = {'FunctionDeclaration', 'ClassDeclaration', 'BlockStatement', 'EmptyStatement', 'MethodDefinition'}
+
+
+class _FullCheckNeeded(Exception):
+    """The edit cannot be validated in isolation, so the whole file is checked"""
 
 class SimpleSecurityValidator:
-    def __init__(self):
+    def __init__(self, pool=None):
+        # Parsing runs in this cpu_pool.CPUPool when given, otherwise in the calling thread
+        self.pool = pool
+        # Each pattern is paired with a literal (lower-case) word that any match must contain,
+        # so patterns whose word is absent from the code can be skipped without a regex scan
         self.critical_patterns = [
-            r'\beval\s*\(',
-            r'\bnew\s+Function\s*\(',
-            r'\bsetTimeout\s*\(\s*[\'"`]',
-            r'\bsetInterval\s*\(\s*[\'"`]',
-            r'window\s*\[\s*[\'"`]eval[\'"`]\s*\]',
-            r'globalThis\s*\[\s*[\'"`]eval[\'"`]\s*\]',
-            r'document\s*\.\s*write\s*\(',
-            r'innerHTML\s*=',
-            r'outerHTML\s*=',
-            r'insertAdjacentHTML\s*\(',
-            r'fetch\s*\(',
-            r'XMLHttpRequest',
-            r'WebSocket\s*\(',
-            r'Object\s*\.\s*prototype',
-            r'__proto__\s*=',
-            r'constructor\s*\.\s*prototype',
-            r'import\s*\(',
-            r'require\s*\(',
-            r'process\s*\.',
-            r'global\s*\.',
-            r'Buffer\s*\.'
+            (r'\beval\s*\(', 'eval'),
+            (r'\bnew\s+Function\s*\(', 'function'),
+            (r'\bsetTimeout\s*\(\s*[\'"`]', 'settimeout'),
+            (r'\bsetInterval\s*\(\s*[\'"`]', 'setinterval'),
+            (r'window\s*\[\s*[\'"`]eval[\'"`]\s*\]', 'window'),
+            (r'globalThis\s*\[\s*[\'"`]eval[\'"`]\s*\]', 'globalthis'),
+            (r'document\s*\.\s*write\s*\(', 'document'),
+            (r'innerHTML\s*=', 'innerhtml'),
+            (r'outerHTML\s*=', 'outerhtml'),
+            (r'insertAdjacentHTML\s*\(', 'insertadjacenthtml'),
+            (r'fetch\s*\(', 'fetch'),
+            (r'XMLHttpRequest', 'xmlhttprequest'),
+            (r'WebSocket\s*\(', 'websocket'),
+            (r'Object\s*\.\s*prototype', 'object'),
+            (r'__proto__\s*=', '__proto__'),
+            (r'constructor\s*\.\s*prototype', 'constructor'),
+            (r'import\s*\(', 'import'),
+            (r'require\s*\(', 'require'),
+            (r'process\s*\.', 'process'),
+            (r'global\s*\.', 'global'),
+            (r'Buffer\s*\.', 'buffer')
         ]
-    
+        self.compiled_patterns = [
+            (pattern, keyword, re.compile(pattern, re.IGNORECASE))
+            for pattern, keyword in self.critical_patterns
+        ]
+        # Results by code hash; editor saves and reloads often submit unchanged code
+        self.cache = TTLCache(
+            max_size=int(os.environ.get("VALIDATION_CACHE_SIZE", "512")),
+            ttl=float(os.environ.get("VALIDATION_CACHE_TTL", "3600"))
+        )
+        # Last validated code of each session, split into independently parseable chunks
+        self.sessions = TTLCache(
+            max_size=int(os.environ.get("VALIDATION_SESSION_CACHE_SIZE", "512")),
+            ttl=float(os.environ.get("VALIDATION_SESSION_CACHE_TTL", "7200"))
+        )
+
     def validate(self, code):
+        key = content_hash(code)
+        cached = self.cache.get(key)
+        if cached is None:
+            try:
+                cached = self._run('_validate', code)
+            except TimeoutError as e:
+                return self._timed_out(e)
+            self.cache.set(key, cached)
+        return {
+            'is_safe': cached['is_safe'],
+            'violations': list(cached['violations'])
+        }
+
+    def validate_incremental(self, session_id, code):
+        """Validate code against the session's last validated version.
+
+        The previous code is kept as chunks: top-level statements, and the methods of
+        top-level classes. Only chunks touched by the edit are rescanned with the regex
+        layer and reparsed, together with the chunk on either side, so a statement the
+        edit joins to its neighbour (e.g. through automatic semicolon insertion) is seen
+        whole; unchanged chunks keep their earlier results. Edits to a class header or
+        closing brace, a "use strict" prologue, a region that does not parse on its own,
+        whose statement boundaries with its neighbours moved, or that does not end with an
+        explicit terminator fall back to validating the whole file.
+        """
+        lines = code.split('\n')
+        previous = self.sessions.get(session_id)
+        if previous is not None and previous['lines'] == lines:
+            result, state = previous['result'], previous
+        else:
+            try:
+                result, state, fallback = self._run('_check', previous, lines)
+            except TimeoutError as e:
+                self.sessions.pop(session_id)
+                return self._timed_out(e)
+            if fallback:
+                print(f"Full validation for session {session_id}: {fallback}")
+        if state is not None:
+            self.sessions.set(session_id, state)
+        else:
+            self.sessions.pop(session_id)
+        return {
+            'is_safe': result['is_safe'],
+            'violations': list(result['violations'])
+        }
+
+    def _run(self, method, *args):
+        if self.pool is None:
+            return getattr(self, method)(*args)
+        return self.pool.run(run_in_process, method, *args)
+
+    def _timed_out(self, error):
+        # Not cached: the same code may pass once the server is less loaded
+        print(f"Validation timed out: {error}")
+        return {
+            'is_safe': False,
+            'violations': ["Code validation took too long; simplify the script and try again"]
+        }
+
+    def _check(self, previous, lines):
+        """Incremental check when possible, else a full one; returns (result, state, fallback reason)"""
+        fallback = None
+        if previous is not None:
+            try:
+                return self._revalidate(previous, lines) + (None,)
+            except _FullCheckNeeded as e:
+                fallback = str(e)
+        return self._validate_chunked('\n'.join(lines), lines) + (fallback,)
+
+    def _validate_chunked(self, code, lines):
+        """Full validation that also records the chunk state for later incremental checks"""
+        violations = self._check_patterns(code)
+        try:
+            ast = esprima.parseScript(code, {'loc': True})
+        except Exception as e:
+            violations.append(f"Code parsing failed: {str(e)}")
+            return {'is_safe': False, 'violations': violations}, None
+        chunks = self._build_chunks(ast.body, 'top', 0, len(lines), 0, lines)
+        for index in range(len(chunks) - 1):
+            chunks[index]['tail'] = self._boundary_patterns(lines, chunks[index]['end'])
+        violations.extend(next((chunk['ast'] for chunk in chunks if chunk['ast']), []))
+        result = {'is_safe': len(violations) == 0, 'violations': violations}
+        strict = bool(ast.body) and getattr(ast.body[0], 'directive', None) is not None
+        return result, {'lines': lines, 'chunks': chunks, 'strict': strict, 'result': result}
+
+    def _revalidate(self, previous, lines):
+        if previous['strict']:
+            raise _FullCheckNeeded("strict mode prologue")
+        old_lines, chunks = previous['lines'], previous['chunks']
+        starts = [chunk['start'] for chunk in chunks]
+        opcodes = get_opcodes(old_lines, lines)
+        equal = [op for op in opcodes if op[0] == 'equal']
+        equal_starts = [op[1] for op in equal]
+
+        def new_line(old):
+            # Only called for lines of untouched chunks, which are always in an equal opcode
+            _, i1, _, j1, _ = equal[bisect_right(equal_starts, old) - 1]
+            return j1 + old - i1
+
+        dirty = [False] * len(chunks)
+        for tag, i1, i2, _, _ in opcodes:
+            if tag == 'equal':
+                continue
+            # Insertions belong to the chunk ending just before them
+            first = bisect_right(starts, max(i1 - 1, 0) if i1 == i2 else i1) - 1
+            last = bisect_right(starts, max(i2 - 1, 0)) - 1
+            for index in range(first, max(first, last) + 1):
+                dirty[index] = True
+        # Neighbours are reparsed too: an edit can change where the statements around it end
+        edited = list(dirty)
+        for index, changed in enumerate(edited):
+            if changed:
+                for neighbour in (index - 1, index + 1):
+                    if 0 <= neighbour < len(chunks) and chunks[neighbour]['kind'] == chunks[index]['kind']:
+                        dirty[neighbour] = True
+
+        new_chunks, dirty_ranges = [], []
+        index = 0
+        while index < len(chunks):
+            if not dirty[index]:
+                chunk = dict(chunks[index])
+                chunk['start'] = new_line(chunk['start'])
+                chunk['end'] = new_line(chunk['end'] - 1) + 1
+                new_chunks.append(chunk)
+                index += 1
+                continue
+            end = index
+            while end + 1 < len(chunks) and dirty[end + 1]:
+                end += 1
+            kinds = {chunks[i]['kind'] for i in range(index, end + 1)}
+            if 'skeleton' in kinds:
+                raise _FullCheckNeeded("class declaration changed")
+            if len(kinds) > 1:
+                raise _FullCheckNeeded("edit spans class boundary")
+            start = 0 if index == 0 else new_line(chunks[index]['start'] - 1) + 1
+            stop = len(lines) if end + 1 == len(chunks) else new_line(chunks[end + 1]['start'])
+            region = self._reparse_region(kinds.pop(), start, stop, lines)
+            # Unchanged neighbours must come out of the reparse as the same statements
+            if not edited[index] and (not region or region[0]['end'] != new_line(chunks[index]['end'] - 1) + 1):
+                raise _FullCheckNeeded("statement boundaries changed")
+            if not edited[end] and (not region or region[-1]['start'] != new_line(chunks[end]['start'])):
+                raise _FullCheckNeeded("statement boundaries changed")
+            new_chunks.extend(region)
+            dirty_ranges.append((start, stop))
+            index = end + 1
+
+        for index in range(len(new_chunks) - 1):
+            chunk = new_chunks[index]
+            window = self._boundary_window(lines, chunk['end'])
+            if ('tail' not in chunk or new_chunks[index + 1].get('fresh') or chunk.get('fresh') or
+                    any(window[0] <= stop and start <= window[1] for start, stop in dirty_ranges)):
+                chunk['tail'] = self._boundary_patterns(lines, chunk['end'])
+        for chunk in new_chunks:
+            chunk.pop('fresh', None)
+        # The only rule a lone member parse cannot see: one constructor per class
+        constructors = 0
+        for chunk in new_chunks:
+            constructors = constructors + chunk.get('constructors', 0) if chunk['kind'] == 'member' else 0
+            if constructors > 1:
+                raise _FullCheckNeeded("class has more than one constructor")
+        new_chunks[-1].pop('tail', None)
+
+        matched = set()
+        for chunk in new_chunks:
+            matched |= chunk['patterns'] | chunk.get('tail', frozenset())
+        violations = [
+            f"Dangerous pattern detected: {self.compiled_patterns[index][0]}"
+            for index in sorted(matched)
+        ]
+        violations.extend(next((chunk['ast'] for chunk in new_chunks if chunk['ast']), []))
+        result = {'is_safe': len(violations) == 0, 'violations': violations}
+        return result, {'lines': lines, 'chunks': new_chunks, 'strict': False, 'result': result}
+
+    def _reparse_region(self, kind, start, stop, lines):
+        """Parse lines [start, stop) on their own and split them into fresh chunks"""
+        if start == stop:
+            return []
+        text = '\n'.join(lines[start:stop])
+        try:
+            if kind == 'top':
+                ast = esprima.parseScript(text, {'loc': True})
+                statements, offset = ast.body, start
+                if start == 0 and statements and getattr(statements[0], 'directive', None) is not None:
+                    raise _FullCheckNeeded("strict mode prologue")
+            else:
+                ast = esprima.parseScript(f"{MEMBER_WRAPPER}\n{text}\n}}", {'loc': True})
+                statements, offset = ast.body[0].body.body, start - 1
+        except _FullCheckNeeded:
+            raise
+        except Exception as e:
+            raise _FullCheckNeeded(f"changed region does not parse on its own ({e})")
+        if stop < len(lines) and statements and not self._ends_explicitly(statements[-1], offset, lines):
+            raise _FullCheckNeeded("changed region does not end with an explicit terminator")
+        chunks = self._build_chunks(statements, kind, start, stop, offset, lines)
+        for chunk in chunks:
+            chunk['fresh'] = True
+        return chunks
+
+    def _ends_explicitly(self, node, offset, lines):
+        """True if node ends with a semicolon or a closing brace that nothing can continue"""
+        while True:
+            if node.type == 'IfStatement':
+                node = node.alternate or node.consequent
+            elif node.type in ('ForStatement', 'ForInStatement', 'ForOfStatement', 'WhileStatement',
+                               'WithStatement', 'LabeledStatement'):
+                node = node.body
+            elif node.type == 'TryStatement':
+                node = node.finalizer or node.handler.body
+            else:
+                break
+        if node.type in BRACE_TERMINATED:
+            return True
+        end = node.loc.end
+        return lines[end.line - 1 + offset][:end.column].rstrip().endswith(';')
+
+    def _build_chunks(self, statements, kind, start, stop, offset, lines):
+        """Split lines [start, stop) at statement boundaries; classes are split by member"""
+        groups = []
+        for node in statements:
+            first = node.loc.start.line - 1 + offset
+            last = node.loc.end.line - 1 + offset
+            # Statements sharing a line cannot be reparsed apart
+            if groups and first <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], last)
+                groups[-1][2].append(node)
+            else:
+                groups.append([first, last, [node]])
+        if not groups:
+            return [self._chunk(kind, start, stop, [], lines)]
+        chunks = []
+        for index, (first, last, nodes) in enumerate(groups):
+            chunk_start = start if index == 0 else first
+            chunk_stop = groups[index + 1][0] if index + 1 < len(groups) else stop
+            node = nodes[0]
+            members = node.body.body if kind == 'top' and len(nodes) == 1 and node.type == 'ClassDeclaration' else []
+            member_first = members[0].loc.start.line - 1 + offset if members else None
+            member_last = max(m.loc.end.line for m in members) - 1 + offset if members else None
+            if members and first < member_first and member_last < last:
+                head = [node.superClass] if node.superClass else []
+                chunks.append(self._chunk('skeleton', chunk_start, member_first, head, lines))
+                chunks.extend(self._build_chunks(members, 'member', member_first, member_last + 1, offset, lines))
+                chunks.append(self._chunk('skeleton', member_last + 1, chunk_stop, [], lines))
+            else:
+                chunks.append(self._chunk(kind, chunk_start, chunk_stop, nodes, lines))
+        return chunks
+
+    def _chunk(self, kind, start, stop, nodes, lines):
+        chunk = {
+            'kind': kind,
+            'start': start,
+            'end': stop,
+            'patterns': self._matching_patterns('\n'.join(lines[start:stop])),
+            'ast': self._check_ast(nodes)
+        }
+        if kind == 'member':
+            chunk['constructors'] = sum(1 for node in nodes if getattr(node, 'kind', None) == 'constructor')
+        return chunk
+
+    def _boundary_window(self, lines, boundary):
+        """Lines around a chunk boundary that a single pattern match could span"""
+        window_start, seen = boundary, 0
+        while window_start > 0 and seen < BOUNDARY_LINES:
+            window_start -= 1
+            seen += bool(lines[window_start].strip())
+        window_stop, seen = boundary, 0
+        while window_stop < len(lines) and seen < BOUNDARY_LINES:
+            seen += bool(lines[window_stop].strip())
+            window_stop += 1
+        return window_start, window_stop
+
+    def _boundary_patterns(self, lines, boundary):
+        window_start, window_stop = self._boundary_window(lines, boundary)
+        return self._matching_patterns('\n'.join(lines[window_start:window_stop]))
+
+    def _validate(self, code):
         violations = []
-        
+
         # 1. Basic pattern matching (fast, reliable)
-        for pattern in self.critical_patterns:
-            if re.search(pattern, code, re.IGNORECASE):
-                violations.append(f"Dangerous pattern detected: {pattern}")
-        
+        violations.extend(self._check_patterns(code))
+
         # 2. AST parsing (this actually works with esprima)
         try:
             ast = esprima.parseScript(code)
@@ -42,30 +352,62 @@ class SimpleSecurityValidator:
             violations.extend(ast_violations)
         except Exception as e:
             violations.append(f"Code parsing failed: {str(e)}")
-        
+
         return {
             'is_safe': len(violations) == 0,
             'violations': violations
         }
-    
+
+    def _check_patterns(self, code):
+        return [
+            f"Dangerous pattern detected: {self.compiled_patterns[index][0]}"
+            for index in sorted(self._matching_patterns(code))
+        ]
+
+    def _matching_patterns(self, code):
+        # Case-insensitive regex matching can differ from str.lower() outside ASCII,
+        # so non-ASCII code is checked against every pattern
+        lowered = code.lower() if code.isascii() else None
+        return frozenset(
+            index
+            for index, (pattern, keyword, regex) in enumerate(self.compiled_patterns)
+            if (lowered is None or keyword in lowered) and regex.search(code)
+        )
+
     def _check_ast(self, ast):
-        # Simple AST traversal that actually works
-        violations = []
-        
-        def traverse(node):
-            if isinstance(node, dict):
-                if node.get('type') == 'CallExpression':
-                    callee = node.get('callee', {})
-                    if (callee.get('type') == 'Identifier' and 
-                        callee.get('name') in ['eval', 'Function']):
-                        violations.append(f"Dangerous function call: {callee.get('name')}")
-                
-                for value in node.values():
-                    if isinstance(value, (dict, list)):
-                        traverse(value)
-            elif isinstance(node, list):
-                for item in node:
-                    traverse(item)
-        
-        traverse(ast)
-        return violations
+        # Iterative walk over esprima nodes; stops at the first dangerous call
+        stack = [ast]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(reversed(node))
+                continue
+            if isinstance(node, Node):
+                fields = vars(node)
+            elif isinstance(node, dict):
+                fields = node
+            else:
+                continue
+
+            if fields.get('type') == 'CallExpression':
+                callee = fields.get('callee')
+                callee_fields = vars(callee) if isinstance(callee, Node) else (callee or {})
+                if (callee_fields.get('type') == 'Identifier' and
+                    callee_fields.get('name') in DANGEROUS_CALLS):
+                    return [f"Dangerous function call: {callee_fields.get('name')}"]
+
+            for value in fields.values():
+                if isinstance(value, (Node, dict, list)):
+                    stack.append(value)
+        return []
+
+
+_process_validator = None
+
+
+def run_in_process(method, *args):
+    """Entry point for CPUPool workers: call a validator method in the worker process"""
+    global _process_validator
+    if _process_validator is None:
+        _process_validator = SimpleSecurityValidator()
+    return getattr(_process_validator, method)(*args)
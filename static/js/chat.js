@@ -56,28 +56,29 @@ inputForm.addEventListener('submit', function(e) {
         body: JSON.stringify({ 
             context : context,
             input: input,
-            extended_thinking: extendedThinking })
+            extended_thinking: extendedThinking,
+            stream: !extendedThinking })
     })
-    .then(response => response.json())
-    .then(data => {
-        // Remove loading message
-        const loadingElem = document.getElementById(loadingId);
-        if (loadingElem) loadingElem.remove();
-        if (data.error) {
-            addMessage('Error: ' + data.error, 'error-message');
-        } else {
-            // Add LLM response to display
-            console.log('chat.js: LLM Response:', typeof(data), data);
-            data.forEach(element => {
-                console.log('Element:', element);
-                if (element[0] === 'text') {
-                    addMessage(element[1], 'llm-response');
-                }
-                if (element[0] === 'code') {
-                    addMessage(element[1], 'llm-code');
-                }
-            });
+    .then(response => {
+        const contentType = response.headers.get('Content-Type') || '';
+        if (contentType.includes('application/x-ndjson') && response.body) {
+            return readStreamedResponse(response, loadingId);
         }
+        return response.json().then(data => {
+            // Remove loading message
+            const loadingElem = document.getElementById(loadingId);
+            if (loadingElem) loadingElem.remove();
+            if (data.error) {
+                addMessage('Error: ' + data.error, 'error-message');
+            } else {
+                // Add LLM response to display
+                console.log('chat.js: LLM Response:', typeof(data), data);
+                data.forEach(element => {
+                    console.log('Element:', element);
+                    addSegment(element);
+                });
+            }
+        });
     })
     .catch(error => {
         const loadingElem = document.getElementById(loadingId);
@@ -87,6 +88,63 @@ inputForm.addEventListener('submit', function(e) {
     });
 });
 
+function addSegment(element) {
+    if (element[0] === 'text') {
+        addMessage(element[1], 'llm-response');
+    }
+    if (element[0] === 'code') {
+        addMessage(element[1], 'llm-code');
+    }
+}
+
+// Read newline-delimited JSON events from /LLMrequest. Tokens are shown in the
+// loading element as they arrive; finished segments replace them as normal messages.
+function readStreamedResponse(response, loadingId) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const liveDiv = document.getElementById(loadingId);
+    let pending = '';
+    let liveText = '';
+
+    function handleEvent(event) {
+        if (event.type === 'token') {
+            liveText += event.text;
+            if (liveDiv) liveDiv.textContent = liveText;
+            scrollToBottom();
+        } else if (event.type === 'segment') {
+            // Keep the live element last so later tokens appear below finished segments
+            addSegment(event.segment);
+            liveText = event.pending || '';
+            if (liveDiv) {
+                liveDiv.textContent = liveText;
+                outputDiv.appendChild(liveDiv);
+            }
+        } else if (event.type === 'error') {
+            addMessage('Error: ' + event.error, 'error-message');
+        }
+    }
+
+    function pump() {
+        return reader.read().then(({ done, value }) => {
+            if (value) {
+                pending += decoder.decode(value, { stream: !done });
+                const lines = pending.split('\n');
+                pending = lines.pop();
+                lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+            }
+            if (done) {
+                if (pending.trim()) handleEvent(JSON.parse(pending));
+                if (liveDiv) liveDiv.remove();
+                saveChatToStorage();
+                return;
+            }
+            return pump();
+        });
+    }
+
+    return pump();
+}
+
 // Auto-resize textarea
 document.addEventListener('DOMContentLoaded', function() {
     const textarea = document.getElementById('user-input');
@@ -12,7 +12,8 @@ document.addEventListener('DOMContentLoaded', function() {
     editor.setTheme("ace/theme/monokai");
     editor.session.setMode("ace/mode/javascript");
 
-    fetch('/get-user-game-code')
+    // Revalidate with the server's ETag; an unchanged script comes back as a 304
+    fetch('/get-user-game-code', { cache: 'no-cache' })
       .then(response => response.json())
       .then(data => {
         if (data.success) {
@@ -81,7 +82,7 @@ function reloadGame() {
     clearDebugConsole();
 
     // Reload and re-execute the game script
-    fetch("/get-user-game-code")
+    fetch("/get-user-game-code", { cache: "no-cache" })
         .then(response => response.json())
         .then(gameCode => {
             if (gameCode.success){
@@ -0,0 +1,169 @@
+import builtins
+import json
+import multiprocessing
+
+import pytest
+
+import conversation_store
+from conversation_store import (
+    MemoryConversationStore, RedisConversationStore, SQLiteConversationStore, create_store_from_env
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(conversation_store.time, "monotonic", clock)
+    return clock
+
+
+def test_memory_evicts_least_recently_used(clock):
+    store = MemoryConversationStore(max_sessions=2)
+    store.append("a", {"role": "user", "content": "1"})
+    store.append("b", {"role": "user", "content": "2"})
+    store.get("a")  # a is now more recent than b
+    store.append("c", {"role": "user", "content": "3"})
+    assert "a" in store and "c" in store and "b" not in store
+    assert store.stats()["evictions"] == 1
+
+
+def test_memory_expires_idle_sessions(clock):
+    store = MemoryConversationStore(idle_ttl=60)
+    store.append("a", {"role": "user", "content": "1"})
+    store.set_meta("a", "code", "let x = 1;")
+    clock.now += 59
+    assert store.get("a") == [{"role": "user", "content": "1"}]
+    clock.now += 61
+    assert store.get("a") == []
+    assert store.get_meta("a", "code") is None
+    assert store.stats()["bytes"] == 0
+
+
+def test_memory_evicts_down_to_byte_cap(clock):
+    message = {"role": "user", "content": "x" * 100}
+    size = len(json.dumps(message))
+    store = MemoryConversationStore(max_bytes=2 * size + 10)
+    for session_id in ("a", "b", "c"):
+        clock.now += 1
+        store.append(session_id, message)
+    stats = store.stats()
+    assert stats == {"backend": "memory", "sessions": 2, "bytes": 2 * size, "evictions": 1}
+    assert "a" not in store
+
+
+def test_memory_keeps_the_session_being_written(clock):
+    store = MemoryConversationStore(max_bytes=10)
+    store.append("a", {"role": "user", "content": "longer than the cap"})
+    assert len(store.get("a")) == 1
+
+
+def append_messages(path, session_id, count):
+    store = SQLiteConversationStore(path)
+    for i in range(count):
+        store.append(session_id, {"role": "user", "content": str(i)})
+    store.set_meta(session_id, "writer", session_id)
+
+
+def test_sqlite_shared_between_processes(tmp_path):
+    path = str(tmp_path / "conversations.db")
+    SQLiteConversationStore(path)
+    workers = [multiprocessing.Process(target=append_messages, args=(path, session_id, 50)) for session_id in ("a", "b")]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    store = SQLiteConversationStore(path)
+    for session_id in ("a", "b"):
+        assert [m["content"] for m in store.get(session_id)] == [str(i) for i in range(50)]
+        assert store.get_meta(session_id, "writer") == session_id
+    assert store.get("a", start=48) == [{"role": "user", "content": "48"}, {"role": "user", "content": "49"}]
+    assert store.stats()["sessions"] == 2
+
+
+def test_sqlite_sweeps_idle_and_overflowing_sessions(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(conversation_store.time, "time", clock)
+    store = SQLiteConversationStore(str(tmp_path / "conversations.db"), max_sessions=2, idle_ttl=60, sweep_interval=0)
+    store.append("old", {"content": "1"})
+    clock.now += 120
+    store.append("a", {"content": "2"})
+    assert "old" not in store
+    clock.now += 1
+    store.append("b", {"content": "3"})
+    clock.now += 1
+    store.append("c", {"content": "4"})
+    assert "a" not in store and "b" in store and "c" in store
+
+
+class FakeRedis:
+    """The subset of redis.Redis that RedisConversationStore uses, returning bytes like the real client"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttl = {}
+
+    def rpush(self, key, value):
+        self.data.setdefault(key, []).append(value.encode())
+        return len(self.data[key])
+
+    def lrange(self, key, start, end):
+        items = self.data.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value.encode()
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def expire(self, key, seconds):
+        if key in self.data:
+            self.ttl[key] = seconds
+        return key in self.data
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.ttl.pop(key, None)
+
+
+def test_redis_round_trip_and_expiry():
+    client = FakeRedis()
+    store = RedisConversationStore(client, idle_ttl=90)
+    assert "s" not in store
+    store.append("s", {"role": "user", "content": "hi"})
+    store.append("s", {"role": "assistant", "content": "hello"})
+    store.set_meta("s", "code", {"revision": 3})
+    assert "s" in store
+    assert store.get("s", start=1) == [{"role": "assistant", "content": "hello"}]
+    assert store.get_meta("s", "code") == {"revision": 3}
+    assert store.get_meta("s", "missing", "default") == "default"
+    assert client.ttl == {"conversation:s:messages": 90, "conversation:s:meta": 90}
+    store.clear("s")
+    assert "s" not in store and store.get("s") == []
+
+
+def test_redis_url_without_package(monkeypatch):
+    real_import = builtins.__import__
+
+    def no_redis(name, *args, **kwargs):
+        if name == "redis":
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", no_redis)
+    monkeypatch.setenv("CONVERSATION_STORE", "redis://localhost:6379/0")
+    with pytest.raises(RuntimeError, match="redis package"):
+        create_store_from_env()
@@ -0,0 +1,27 @@
+import pytest
+from flask import Flask
+
+from data import db
+from migrate_database import HOT_QUERIES, query_plan
+
+
+@pytest.fixture(scope="module")
+def connection():
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        with db.engine.connect() as conn:
+            yield conn
+
+
+def test_every_declared_index_has_a_hot_query():
+    declared = {index.name for table in db.metadata.tables.values() for index in table.indexes}
+    assert declared == {index_name for index_name, _ in HOT_QUERIES}
+
+
+@pytest.mark.parametrize("index_name, query", HOT_QUERIES, ids=[name for name, _ in HOT_QUERIES])
+def test_hot_query_uses_its_index(connection, index_name, query):
+    plan = query_plan(connection, query)
+    assert index_name in plan, plan
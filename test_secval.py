@@ -0,0 +1,28 @@
+from secval import SimpleSecurityValidator
+
+
+def check_edit(previous, code):
+    """Validate previous, then code incrementally, and return both results for code"""
+    validator = SimpleSecurityValidator()
+    validator.validate_incremental("session", previous)
+    return validator.validate_incremental("session", code), SimpleSecurityValidator().validate(code)
+
+
+def test_edit_joining_next_statement_through_asi():
+    previous = 'let a = 1;\nfoo;\n("alert(1)")();\nlet b = 2;'
+    incremental, full = check_edit(previous, previous.replace("foo;", "Function"))
+    assert full["violations"] == ["Dangerous function call: Function"]
+    assert incremental == full
+
+
+def test_edit_joined_by_previous_statement_through_asi():
+    previous = 'let a = 1;\nFunction\nlet c = 3;\nlet b = 2;'
+    incremental, full = check_edit(previous, previous.replace("let c = 3;", '("alert(1)")();'))
+    assert not full["is_safe"]
+    assert incremental == full
+
+
+def test_edit_inside_statement_without_semicolon():
+    previous = 'let a = 1;\nlet x = 2\nlet b = 2;\neval\nlet c = 3;'
+    incremental, full = check_edit(previous, previous.replace("let b = 2;", 'let b = 2\n("x")'))
+    assert incremental == full